@@ -12,24 +12,63 @@ Examples:
     For example usage, see `python3 infrastaller.py --help`.
 """
 
+import functools
+import gzip
+import hashlib
+import http.client
 import json
 import os
+import pickle
 import shutil
+import struct
 import sys
 import tarfile
 import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
 import zipfile
+import zlib
 from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import Path, PurePath
-from typing import Union
+from typing import Callable, Optional, Union
 
 import click
 import logzero
 from logzero import logger
 
+try:
+    import zstandard
+except ImportError:  # Only needed for 'tarzst' archives.
+    zstandard = None
+
 DEFAULT_BIN_PATH = Path("/usr/local/bin")
 DEFAULT_CONFIG_PATH = Path.cwd() / "packages.json"
+DEFAULT_HOST_CONNECTIONS = 6
+DEFAULT_JOBS = 1
+DEFAULT_RETRIES = 3
+DEFAULT_SEGMENTS = 1
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60  # seconds
+MAX_REDIRECTS = 10
+RETRY_BACKOFF = 1.0  # seconds, doubled after each retry
+RETRY_HTTP_CODES = (408, 429)  # ...and any 5xx
+RETRYABLE_ERRORS = (urllib.error.URLError, ConnectionError, TimeoutError, http.client.HTTPException)
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+DEFAULT_CACHE_PATH = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "infrastaller"
+)
+DEFAULT_CACHE_SIZE = 2048  # MiB
+MANIFEST_NAME = ".infrastaller.json"
+ARCHIVE_TYPES = ("targz", "tarxz", "tarzst", "zip", "gz")
+CATALOG_FORMAT = 2  # Bump whenever `Catalog` or `compile_config()` output changes.
+TAR_STREAM_MODES = {"targz": "r|gz", "tarxz": "r|xz", "tarzst": "r|"}
+USER_AGENT = "infrastaller"
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
 #
 # `SYSTEM` and `MACHINE` are used for replacing templated strings in the config file, namely
 # the `url` and `file_to_extract` fields. `SYSTEM` should resolve to 'linux' or 'darwin', and
@@ -40,6 +79,373 @@ SYSTEM = os.uname().sysname.lower()
 MACHINE = os.uname().machine.lower().replace("x86_64", "amd64")
 
 
+@dataclass
+class Download:
+    """The result of a (possibly conditional) download.
+
+    Attributes:
+        path: The full path to the downloaded file, or None if the server answered
+            '304 Not Modified'.
+        etag: The response's ETag header, if any.
+        last_modified: The response's Last-Modified header, if any.
+        sha256: The hex SHA-256 digest of the response body, if it was read to the end.
+    """
+
+    path: Optional[Path]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    sha256: Optional[str] = None
+
+
+class HashingReader:
+    """Wraps a readable binary stream, hashing and counting everything read through it.
+
+    Args:
+        stream: The file-like object to read from.
+    """
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.exhausted = False
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads and hashes up to `size` bytes."""
+        data = self.stream.read(size)
+        self._update(data, size != 0)
+        return data
+
+    def readinto(self, buffer) -> int:
+        """Reads and hashes up to `len(buffer)` bytes into a buffer."""
+        length = self.stream.readinto(buffer)
+        self._update(memoryview(buffer)[:length], len(buffer) != 0)
+        return length
+
+    def drain(self) -> None:
+        """Reads (and hashes) the rest of the stream, discarding it."""
+        buffer = bytearray(DOWNLOAD_CHUNK_SIZE)
+        while self.readinto(buffer):
+            pass
+
+    def hexdigest(self) -> Optional[str]:
+        """Returns the digest of the whole stream, or None if it hasn't all been read."""
+        return self.digest.hexdigest() if self.exhausted else None
+
+    def _update(self, data, wanted_data: bool) -> None:
+        if not data and wanted_data:
+            self.exhausted = True
+        self.digest.update(data)
+        self.size += len(data)
+
+
+class ConnectionPool:
+    """Keeps HTTP(S) connections open between requests so that they can be reused.
+
+    Connections are pooled per scheme, host and port, and at most `max_per_host` are open to
+    any one host at a time. Redirects are followed, and error responses are raised as
+    `urllib.error.HTTPError`, just as `urllib.request.urlopen()` would.
+
+    Responses must be closed (they are context managers) to give their connection back; one
+    that wasn't read to the end is closed rather than reused.
+
+    Args:
+        max_per_host: The maximum number of simultaneous connections to a single host.
+    """
+
+    def __init__(self, max_per_host: int = DEFAULT_HOST_CONNECTIONS) -> None:
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.opened = 0
+        self.reused = 0
+
+    def request(self, url: str, headers: Optional[dict] = None) -> "PooledResponse":
+        """Sends a GET request and returns the (successful) response."""
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request_once(url, headers or {})
+            if response.status in (301, 302, 303, 307, 308) and response.headers["Location"]:
+                with response:
+                    response.read()
+                url = urllib.parse.urljoin(url, response.headers["Location"])
+                continue
+            if response.status >= 300:
+                with response:
+                    response.read()
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+            return response
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects", None, None)
+
+    def close(self) -> None:
+        """Closes every idle connection."""
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+    def _request_once(self, url: str, headers: dict) -> "PooledResponse":
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = f"{parts.path or '/'}?{parts.query}" if parts.query else parts.path or "/"
+
+        with self.lock:
+            slot = self.slots.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+        slot.acquire()
+        try:
+            while True:
+                connection, reused = self._checkout(key)
+                try:
+                    connection.request("GET", path, headers={"User-Agent": USER_AGENT, **headers})
+                    response = connection.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    connection.close()
+                    if not reused:
+                        raise
+                    #
+                    # The server closed an idle keep-alive connection; try again on a new one.
+                    #
+        except BaseException:
+            slot.release()
+            raise
+        return PooledResponse(self, key, connection, response, slot)
+
+    def _checkout(self, key: tuple) -> tuple:
+        with self.lock:
+            if self.idle.get(key):
+                self.reused += 1
+                return self.idle[key].pop(), True
+            self.opened += 1
+
+        scheme, host, port = key
+        logger.debug("Opening connection to %s://%s%s", scheme, host, f":{port}" if port else "")
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=DOWNLOAD_TIMEOUT), False
+        return http.client.HTTPConnection(host, port, timeout=DOWNLOAD_TIMEOUT), False
+
+    def _checkin(self, key: tuple, connection: http.client.HTTPConnection) -> None:
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+
+
+class PooledResponse:
+    """An `http.client.HTTPResponse` that hands its connection back to the pool when closed."""
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        key: tuple,
+        connection: http.client.HTTPConnection,
+        response: http.client.HTTPResponse,
+        slot: threading.BoundedSemaphore,
+    ) -> None:
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.slot = slot
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads up to `size` bytes of the body (or all of it)."""
+        return self.response.read(None if size < 0 else size)
+
+    def readinto(self, buffer) -> int:
+        """Reads up to `len(buffer)` bytes of the body into a buffer."""
+        return self.response.readinto(buffer)
+
+    def close(self) -> None:
+        """Releases the connection: back to the pool if the body was read, otherwise closed."""
+        if self.connection is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool._checkin(self.key, self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+        self.slot.release()
+
+    def __enter__(self) -> "PooledResponse":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+connection_pool = ConnectionPool()
+
+
+class RetryBudget:
+    """A per-package allowance of retries, shared by all of a download's connections.
+
+    Args:
+        retries: How many failed requests may be retried in total.
+        backoff: Seconds to wait before the first retry; doubled for each one after that.
+    """
+
+    def __init__(self, retries: int, backoff: float = RETRY_BACKOFF) -> None:
+        self.retries = retries
+        self.backoff = backoff
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def wait(self, source: str, error: Exception) -> None:
+        """Sleeps before retrying a failed request, or re-raises the error if it can't be retried.
+
+        Must be called from the `except` block that caught `error`.
+        """
+        if (
+            isinstance(error, urllib.error.HTTPError)
+            and error.code not in RETRY_HTTP_CODES
+            and error.code < 500
+        ):
+            raise error
+        with self.lock:
+            if self.used >= self.retries:
+                raise error
+            delay = self.backoff * 2**self.used
+            self.used += 1
+        logger.warning("Retrying %s in %.0fs after error: %s", source, delay, error)
+        time.sleep(delay)
+
+
+@dataclass
+class FetchedPackage:
+    """A package that has been downloaded (and extracted) but not yet installed.
+
+    Attributes:
+        binary_name: Filename to give the binary in the install path.
+        binary_path: The full path to the downloaded or extracted binary, or None if the
+            installed binary was revalidated and is still current.
+        download_dir: The temporary directory holding the download; removed after install.
+        manifest: The entry to record for this package in the install manifest.
+        timings: Seconds spent in each phase, keyed by phase name.
+    """
+
+    binary_name: str
+    binary_path: Optional[Path]
+    download_dir: Path
+    manifest: dict
+    timings: dict = field(default_factory=dict)
+
+
+@dataclass
+class Catalog:
+    """A validated and indexed config file, compiled for this system.
+
+    Each package's `url`, `sha256` and `extract.file_to_extract` fields are already resolved
+    for `SYSTEM` and have had their placeholders replaced.
+
+    Attributes:
+        packages: Package metadata, keyed by package name, in config order.
+        groups: The names of each group's packages, keyed by group name.
+        positions: Each package's position in `packages`, keyed by package name.
+        source: The (mtime_ns, size, SYSTEM, MACHINE, CATALOG_FORMAT) of the config file this was
+            compiled from, used to tell whether a saved catalog is still current.
+    """
+
+    packages: dict
+    groups: dict
+    positions: dict
+    source: tuple
+
+
+class DownloadCache:
+    """A persistent, size-bounded store of downloaded packages.
+
+    Each download is stored as `<cache_path>/<key>/<filename>`, where the key is a hash of the
+    templated URL and the package version, next to a `validators.json` holding the response's
+    ETag and Last-Modified headers. Entries are touched whenever they are used, so evicting by
+    modification time removes the least recently used downloads first.
+
+    Args:
+        cache_path: The directory to store downloads in; created if missing.
+        max_size: The size, in bytes, the cache is trimmed back to by `evict()`.
+    """
+
+    def __init__(self, cache_path: Path, max_size: int) -> None:
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+
+    def entry(self, url: str, version: str) -> Path:
+        """Returns the path a download is (or would be) cached at."""
+        key = hashlib.sha256(f"{url}\n{version}".encode()).hexdigest()
+        return self.cache_path / key / os.path.basename(url)
+
+    def staging(self, url: str, version: str) -> Path:
+        """Returns (creating it) the directory a download should be saved in before `put()`.
+
+        Downloading straight into the entry's directory keeps partial downloads around between
+        runs, so they can be resumed.
+        """
+        entry_dir = self.entry(url, version).parent
+        entry_dir.mkdir(exist_ok=True)
+        return entry_dir
+
+    def get(self, url: str, version: str) -> Optional[Path]:
+        """Returns the cached download for a URL and version, if there is one."""
+        cached = self.entry(url, version)
+        if not cached.is_file():
+            return None
+        os.utime(cached)
+        return cached
+
+    def validators(self, url: str, version: str) -> dict:
+        """Returns the ETag and Last-Modified headers the cached download was served with."""
+        try:
+            with open(self.entry(url, version).with_name("validators.json"), "rb") as saved:
+                return json.loads(saved.read())
+        except (OSError, ValueError):
+            return {}
+
+    def put(self, url: str, version: str, download: Download) -> Path:
+        """Moves a completed download into the cache and returns its new path.
+
+        The file is renamed into place, so other readers never see a partial entry.
+        """
+        cached = self.entry(url, version)
+        cached.parent.mkdir(exist_ok=True)
+        with open(cached.with_name("validators.json"), "w", encoding="utf-8") as saved:
+            json.dump({"etag": download.etag, "last_modified": download.last_modified}, saved)
+        os.replace(download.path, cached)
+        return cached
+
+    def discard(self, url: str, version: str) -> None:
+        """Removes a cached download."""
+        shutil.rmtree(self.entry(url, version).parent, ignore_errors=True)
+
+    def evict(self) -> None:
+        """Removes least recently used downloads until the cache fits in `max_size`."""
+        entries = []
+        for entry_dir in self.cache_path.iterdir():
+            if not entry_dir.is_dir():
+                continue
+            stats = [cached.stat() for cached in entry_dir.iterdir() if cached.is_file()]
+            if stats:
+                entries.append(
+                    (
+                        max(stat.st_mtime for stat in stats),
+                        sum(stat.st_size for stat in stats),
+                        entry_dir,
+                    )
+                )
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            logger.debug("Evicting %s from the download cache", entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            cache_size -= size
+
+
 def configure_logging(verbosity: str) -> None:
     """Configures logzero verbosity."""
 
@@ -96,7 +502,80 @@ def configure_logging(verbosity: str) -> None:
     type=click.Choice(["quiet", "normal", "verbose", "debug"], case_sensitive=False),
     help="Set script output type (default: normal).",
 )
-def infrastaller(bin_path: str, config: str, package: tuple, group: tuple, output: str) -> None:
+@click.option(
+    "-j",
+    "--jobs",
+    default=DEFAULT_JOBS,
+    type=click.IntRange(min=1),
+    help=f"Number of packages to download and extract in parallel (default: {DEFAULT_JOBS}).",
+)
+@click.option(
+    "--cache-path",
+    default=DEFAULT_CACHE_PATH,
+    type=click.Path(file_okay=False),
+    help=f"Directory to cache downloads in (default: {DEFAULT_CACHE_PATH}).",
+)
+@click.option(
+    "--cache-size",
+    default=DEFAULT_CACHE_SIZE,
+    type=click.IntRange(min=0),
+    help=f"Maximum size of the download cache in MiB (default: {DEFAULT_CACHE_SIZE}).",
+)
+@click.option("--no-cache", is_flag=True, help="Do not read from or write to the download cache.")
+@click.option("--offline", is_flag=True, help="Install only from the download cache.")
+@click.option(
+    "--revalidate",
+    is_flag=True,
+    help="Ask the server whether already installed packages have changed upstream.",
+)
+@click.option("-f", "--force", is_flag=True, help="Reinstall packages that are already installed.")
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Extract binaries while downloading, without saving archives to disk.",
+)
+@click.option(
+    "--retries",
+    default=DEFAULT_RETRIES,
+    type=click.IntRange(min=0),
+    help=f"Number of failed requests to retry per package (default: {DEFAULT_RETRIES}).",
+)
+@click.option(
+    "--host-connections",
+    default=DEFAULT_HOST_CONNECTIONS,
+    type=click.IntRange(min=1),
+    help=(
+        "Maximum number of simultaneous connections to any one host "
+        f"(default: {DEFAULT_HOST_CONNECTIONS})."
+    ),
+)
+@click.option(
+    "--segments",
+    default=DEFAULT_SEGMENTS,
+    type=click.IntRange(min=1),
+    help=(
+        "Number of connections to download each large package over, if the server allows it "
+        f"(default: {DEFAULT_SEGMENTS})."
+    ),
+)
+def infrastaller(
+    bin_path: str,
+    config: str,
+    package: tuple,
+    group: tuple,
+    output: str,
+    jobs: int,
+    cache_path: str,
+    cache_size: int,
+    no_cache: bool,
+    offline: bool,
+    revalidate: bool,
+    force: bool,
+    stream: bool,
+    retries: int,
+    host_connections: int,
+    segments: int,
+) -> None:
     """Downloads and installs binaries.
 
     \b
@@ -119,6 +598,31 @@ def infrastaller(bin_path: str, config: str, package: tuple, group: tuple, outpu
     Install a group of packages and an individual package:
         $ python3 infrastaller.py --group my-packages --package binary2
 
+    \b
+    Download and extract up to 8 packages at a time:
+        $ python3 infrastaller.py --jobs 8
+
+    \b
+    Install from previously cached downloads without touching the network:
+        $ python3 infrastaller.py --offline
+
+    \b
+    Re-download installed packages only if they have changed upstream:
+        $ python3 infrastaller.py --revalidate
+
+    \b
+    Pull binaries straight out of archives as they download:
+        $ python3 infrastaller.py --stream
+
+    \b
+    Retry flaky downloads up to 5 times, fetching large ones over 4 connections:
+        $ python3 infrastaller.py --retries 5 --segments 4
+
+    \b
+    Packages may list others that must be installed first, e.g. a plugin and its host:
+        "kubectl-krew": {..., "depends_on": ["kubectl"]}
+    Selecting a package also selects what it depends on.
+
     \b
     Enable verbose output:
         $ python3 infrastaller.py --output verbose
@@ -126,104 +630,1055 @@ def infrastaller(bin_path: str, config: str, package: tuple, group: tuple, outpu
 
     configure_logging(output)
 
-    with open(config, "rb") as json_config:
-        logger.debug("Reading config file %s", config)
-        packages_data = json.loads(json_config.read())
+    if no_cache and offline:
+        raise click.UsageError("--offline requires the download cache; drop --no-cache.")
+    if stream and offline:
+        raise click.UsageError("--stream downloads archives; it cannot be used with --offline.")
 
-    for pkg_group, binaries in packages_data.items():
-        for binary, appinfo in binaries.items():
-            #
-            # Package should be installed if:
-            #   - neither 'package' nor 'group' flags are set (i.e. install everything)
-            #   - passed by 'package' flag (user specified a package)
-            #   - the package is part of a group passed by 'group' flag (user specified a group)
-            #
-            if (package or group) and (binary in package or pkg_group in group):
-                install_binary(Path(bin_path), binary, appinfo)
+    cache = None if no_cache else DownloadCache(Path(cache_path), cache_size * 1024 * 1024)
+    connection_pool.max_per_host = host_connections
+
+    catalog = load_config(Path(config))
+    selected = select_packages(catalog, package, group)
+
+    manifest_path = Path(bin_path) / MANIFEST_NAME
+    manifest = read_manifest(manifest_path)
+
+    run_started = time.perf_counter()
+    results = []
+
+    try:
+        #
+        # Downloads and extractions run in the pool, but installs happen here in the main thread,
+        # so only one binary is ever being moved into `bin_path` at a time.
+        #
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+            def start(binary: str, appinfo: dict) -> Optional[Future]:
+                installed = None
+                if not force and is_installed(Path(bin_path), binary, appinfo, manifest):
+                    if not revalidate:
+                        logger.info("%s %s is already installed", binary, appinfo["version"])
+                        return None
+                    installed = manifest[binary]
+                return executor.submit(
+                    fetch_binary,
+                    binary,
+                    appinfo,
+                    cache,
+                    offline,
+                    installed,
+                    stream,
+                    retries,
+                    segments,
+                )
+
+            def finish(future: Future) -> None:
+                fetched = future.result()
+                install_fetched(Path(bin_path), fetched)
+                manifest[fetched.binary_name] = fetched.manifest
+                results.append(fetched)
 
+            schedule(selected, start, finish)
+    finally:
+        if results:
+            write_manifest(manifest_path, manifest)
+
+    if cache:
+        cache.evict()
+
+    connection_pool.close()
+    logger.debug(
+        "HTTP connections: %d opened, %d reused", connection_pool.opened, connection_pool.reused
+    )
+
+    log_summary(results, time.perf_counter() - run_started)
+    if results and any(appinfo.get("depends_on") for _, appinfo in selected):
+        path, seconds = critical_path(selected, results)
+        logger.info("Critical path: %s (%.2fs)", " -> ".join(path), seconds)
     logger.info("Installation complete")
 
 
-def install_binary(install_path: Path, binary_name: str, package_data: dict) -> None:
+def install_binary(install_path: Path, binary_name: str, package_data: dict) -> FetchedPackage:
     """Parses package metadata and wraps all installation steps.
 
     Args:
         install_path: The full path to the install directory.
         binary_name: Filename to give the binary in the install_path.
         package_data: Package metadata from the JSON config file.
+
+    Returns:
+        The installed package, with the time spent in each phase.
+    """
+
+    fetched = fetch_binary(binary_name, package_data)
+    install_fetched(install_path, fetched)
+    return fetched
+
+
+def load_config(config_path: Path) -> Catalog:
+    """Loads the config file as a `Catalog`, reusing a previously compiled copy if it's current.
+
+    The compiled catalog is pickled to `.<config name>.cache` next to the config file. It is
+    only trusted if it was written by the current user and isn't writable by anyone else, and
+    only used if the config file's mtime and size (and this system) are unchanged.
+    """
+
+    config_stat = config_path.stat()
+    source = (config_stat.st_mtime_ns, config_stat.st_size, SYSTEM, MACHINE, CATALOG_FORMAT)
+    compiled_path = config_path.with_name(f".{config_path.name}.cache")
+
+    try:
+        compiled_stat = compiled_path.stat()
+        if compiled_stat.st_uid == os.getuid() and not compiled_stat.st_mode & 0o022:
+            with open(compiled_path, "rb") as compiled:
+                catalog = pickle.load(compiled)
+            if isinstance(catalog, Catalog) and catalog.source == source:
+                logger.debug("Using compiled config %s", compiled_path)
+                return catalog
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    with open(config_path, "rb") as json_config:
+        logger.debug("Reading config file %s", config_path)
+        catalog = compile_config(json.loads(json_config.read()), source)
+
+    try:
+        staging_path = compiled_path.with_name(f"{compiled_path.name}.tmp")
+        with open(staging_path, "wb") as compiled:
+            pickle.dump(catalog, compiled, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(staging_path, compiled_path)
+        logger.debug("Saved compiled config to %s", compiled_path)
+    except OSError as error:
+        logger.debug("Could not save compiled config: %s", error)
+
+    return catalog
+
+
+def compile_config(packages_data: dict, source: tuple = ()) -> Catalog:
+    """Validates a parsed config file and indexes it by package and group.
+
+    Every problem found is logged before exiting, rather than just the first.
+
+    Args:
+        packages_data: The parsed JSON config: packages, keyed by name, inside groups.
+        source: Identifies the config file the data came from (see `Catalog.source`).
+    """
+
+    packages = {}
+    groups = {}
+    errors = []
+
+    for pkg_group, binaries in packages_data.items():
+        groups[pkg_group] = []
+        for binary, appinfo in binaries.items():
+            url = appinfo.get("url")
+            if isinstance(url, Mapping) and SYSTEM not in url:
+                errors.append(f"{binary}: no url for system '{SYSTEM}'")
+                continue
+            if not isinstance(url, (str, Mapping)) or not isinstance(appinfo.get("version"), str):
+                errors.append(f"{binary}: 'url' and 'version' are required")
+                continue
+            if "extract" in appinfo:
+                if appinfo["extract"].get("type_of_archive") not in ARCHIVE_TYPES:
+                    errors.append(
+                        f"{binary}: 'extract.type_of_archive' must be one of {ARCHIVE_TYPES}"
+                    )
+                    continue
+                if not appinfo["extract"].get("file_to_extract"):
+                    errors.append(f"{binary}: 'extract.file_to_extract' is required")
+                    continue
+            depends_on = appinfo.get("depends_on", [])
+            if not isinstance(depends_on, list) or not all(isinstance(d, str) for d in depends_on):
+                errors.append(f"{binary}: 'depends_on' must be a list of package names")
+                continue
+
+            spec = dict(appinfo, url=package_url(appinfo))
+            if isinstance(appinfo.get("sha256"), Mapping):
+                spec["sha256"] = appinfo["sha256"].get(SYSTEM)
+            if "extract" in appinfo:
+                spec["extract"] = dict(
+                    appinfo["extract"],
+                    file_to_extract=replace_placeholder_in_string(
+                        appinfo["extract"]["file_to_extract"], appinfo["version"]
+                    ),
+                )
+
+            if binary in packages:
+                logger.warning(
+                    "%s is defined more than once; using the one in %s", binary, pkg_group
+                )
+                for members in groups.values():
+                    if binary in members:
+                        members.remove(binary)
+                del packages[binary]
+            packages[binary] = spec
+            groups[pkg_group].append(binary)
+
+    for binary, spec in packages.items():
+        for dependency in spec.get("depends_on", []):
+            if dependency not in packages:
+                errors.append(f"{binary}: depends on '{dependency}', which is not defined")
+    if not errors:
+        cycle = find_dependency_cycle(packages)
+        if cycle:
+            errors.append(f"dependency cycle among {', '.join(cycle)}")
+
+    if errors:
+        for error in errors:
+            logger.error("Invalid config: %s", error)
+        sys.exit(1)
+
+    positions = {name: position for position, name in enumerate(packages)}
+    return Catalog(packages, groups, positions, source)
+
+
+def find_dependency_cycle(packages: dict) -> list:
+    """Returns the names of packages caught in (or behind) a `depends_on` cycle, if any.
+
+    Packages are peeled off in dependency order (Kahn's algorithm); whatever can never be peeled
+    off is waiting, directly or not, on a cycle.
+    """
+
+    waiting_on = {name: set(spec.get("depends_on", [])) for name, spec in packages.items()}
+    dependents = {name: [] for name in packages}
+    for name, dependencies in waiting_on.items():
+        for dependency in dependencies:
+            dependents[dependency].append(name)
+
+    ready = [name for name, dependencies in waiting_on.items() if not dependencies]
+    while ready:
+        name = ready.pop()
+        del waiting_on[name]
+        for dependent in dependents[name]:
+            waiting_on[dependent].discard(name)
+            if not waiting_on[dependent]:
+                ready.append(dependent)
+    return [name for name in packages if name in waiting_on]
+
+
+def select_packages(catalog: Catalog, package: tuple, group: tuple) -> list:
+    """Returns the (name, metadata) pairs to install, in config order.
+
+    Everything is selected if neither `package` nor `group` names anything; otherwise the named
+    packages, every member of the named groups, and everything those depend on are.
+    """
+
+    unknown = [name for name in package if name not in catalog.packages]
+    unknown += [name for name in group if name not in catalog.groups]
+    if unknown:
+        logger.error("Not defined in config file: %s", ", ".join(unknown))
+        sys.exit(1)
+
+    if not package and not group:
+        return list(catalog.packages.items())
+
+    names = set(package)
+    for pkg_group in group:
+        names.update(catalog.groups[pkg_group])
+
+    unresolved = list(names)
+    while unresolved:
+        for dependency in catalog.packages[unresolved.pop()].get("depends_on", []):
+            if dependency not in names:
+                logger.debug("Adding %s, a dependency of the selected packages", dependency)
+                names.add(dependency)
+                unresolved.append(dependency)
+
+    return [
+        (name, catalog.packages[name]) for name in sorted(names, key=catalog.positions.__getitem__)
+    ]
+
+
+def schedule(selected: list, start: Callable, finish: Callable) -> None:
+    """Runs packages as soon as everything they depend on has finished.
+
+    Args:
+        selected: The (name, metadata) pairs to run, as returned by `select_packages()`.
+        start: Called with a package's name and metadata once its dependencies have finished;
+            returns a future for the package's work, or None if there is nothing to do.
+        finish: Called in this thread with each completed future, in config order when several
+            complete at once. The package counts as finished once this returns.
     """
 
-    logger.info("Installing %s...", binary_name)
+    metadata = dict(selected)
+    positions = {name: position for position, name in enumerate(metadata)}
+    waiting_on = {
+        name: set(appinfo.get("depends_on", [])) & metadata.keys() for name, appinfo in selected
+    }
+    dependents = {name: [] for name in metadata}
+    for name, dependencies in waiting_on.items():
+        for dependency in dependencies:
+            dependents[dependency].append(name)
+    running = {}
+
+    def launch(name: str) -> None:
+        future = start(name, metadata[name])
+        if future is None:
+            finished(name)
+        else:
+            running[future] = name
+
+    def finished(name: str) -> None:
+        for dependent in dependents[name]:
+            waiting_on[dependent].discard(name)
+            if not waiting_on[dependent]:
+                launch(dependent)
+
+    for name in [name for name in metadata if not waiting_on[name]]:
+        launch(name)
+
+    while running:
+        completed, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in sorted(completed, key=lambda future: positions[running[future]]):
+            name = running.pop(future)
+            finish(future)
+            finished(name)
+
+
+def critical_path(selected: list, results: list) -> tuple:
+    """Finds the chain of dependent packages that took longest end to end.
+
+    Args:
+        selected: The (name, metadata) pairs that were run.
+        results: The fetched packages, whose timings give each package's duration; packages
+            without a result (e.g. already installed) count as taking no time.
+
+    Returns:
+        The package names along the path, first dependency first, and its total seconds.
+    """
+
+    metadata = dict(selected)
+    durations = {fetched.binary_name: sum(fetched.timings.values()) for fetched in results}
+    longest = {}
+
+    def visit(name: str) -> float:
+        if name not in longest:
+            dependencies = [d for d in metadata[name].get("depends_on", []) if d in metadata]
+            slowest = max(dependencies, key=visit, default=None)
+            upstream = visit(slowest) if slowest else 0.0
+            longest[name] = (durations.get(name, 0.0) + upstream, slowest)
+        return longest[name][0]
+
+    end = max(metadata, key=visit)
+    path = [end]
+    while longest[path[-1]][1]:
+        path.append(longest[path[-1]][1])
+    return path[::-1], longest[end][0]
+
+
+def package_url(package_data: dict) -> str:
+    """Returns a package's download URL for this system with all placeholders replaced."""
 
     #
     # The `url` field can be a string or dictionary depending on if the link is template-able.
     # See the README for more information.
     #
     if isinstance(package_data["url"], Mapping):
-        url = replace_placeholder_in_string(package_data["url"][SYSTEM], package_data["version"])
+        return replace_placeholder_in_string(package_data["url"][SYSTEM], package_data["version"])
+    return replace_placeholder_in_string(package_data["url"], package_data["version"])
+
+
+def is_installed(install_path: Path, binary_name: str, package_data: dict, manifest: dict) -> bool:
+    """Checks the install manifest for a binary at the configured version and URL.
+
+    Args:
+        install_path: The full path to the install directory.
+        binary_name: Filename of the binary in the install_path.
+        package_data: Package metadata from the JSON config file.
+        manifest: The install manifest, as returned by `read_manifest()`.
+    """
+
+    installed = manifest.get(binary_name)
+    return (
+        installed is not None
+        and installed.get("version") == package_data["version"]
+        and installed.get("url") == package_url(package_data)
+        and PurePath.joinpath(install_path, binary_name).exists()
+    )
+
+
+def read_manifest(manifest_path: Path) -> dict:
+    """Reads the install manifest, which maps each installed binary to its source metadata."""
+    try:
+        with open(manifest_path, "rb") as manifest_file:
+            logger.debug("Reading install manifest %s", manifest_path)
+            return json.loads(manifest_file.read())
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning("Ignoring unreadable install manifest %s", manifest_path)
+        return {}
+
+
+def write_manifest(manifest_path: Path, manifest: dict) -> None:
+    """Atomically writes the install manifest."""
+    logger.debug("Writing install manifest %s", manifest_path)
+    staging_path = manifest_path.with_name(f"{manifest_path.name}.tmp")
+    with open(staging_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(staging_path, manifest_path)
+
+
+def fetch_binary(
+    binary_name: str,
+    package_data: dict,
+    cache: Optional[DownloadCache] = None,
+    offline: bool = False,
+    installed: Optional[dict] = None,
+    stream: bool = False,
+    retries: int = DEFAULT_RETRIES,
+    segments: int = DEFAULT_SEGMENTS,
+) -> FetchedPackage:
+    """Downloads a package and extracts its binary into a temporary directory.
+
+    This is the thread-safe half of an install: nothing outside of the new temporary directory
+    (and the package's own cache entry) is touched, so it may run concurrently with other fetches.
+
+    Args:
+        binary_name: Filename to give the binary in the install path.
+        package_data: Package metadata from the JSON config file.
+        cache: The download cache to read from and save to, if any.
+        offline: Fail instead of downloading when the package is not cached.
+        installed: The package's install manifest entry, if it should be revalidated with a
+            conditional request rather than downloaded unconditionally.
+        stream: Extract archives as they download instead of saving them first; cached
+            archives are still used, but streamed ones are not added to the cache.
+        retries: How many failed requests to retry before giving up on the package.
+        segments: How many connections to download a large package over.
+    """
+
+    logger.info("Fetching %s...", binary_name)
+
+    url = package_url(package_data)
+    version = package_data["version"]
+
+    #
+    # Like `url`, the optional `sha256` field can be a dictionary keyed by system.
+    #
+    if isinstance(package_data.get("sha256"), Mapping):
+        sha256 = package_data["sha256"].get(SYSTEM)
     else:
-        url = replace_placeholder_in_string(package_data["url"], package_data["version"])
+        sha256 = package_data.get("sha256")
 
+    timings = {}
     download_dir = Path(tempfile.mkdtemp())
-    downloaded_file = download(url, download_dir)
+    manifest = {"version": version, "url": url}
 
+    unpack = None
     if "extract" in package_data:
-        binary_to_install = extract(
-            package_data["extract"]["type_of_archive"],
-            replace_placeholder_in_string(
-                package_data["extract"]["file_to_extract"], package_data["version"]
-            ),
-            downloaded_file,
+        type_of_archive = package_data["extract"]["type_of_archive"]
+        file_to_extract = replace_placeholder_in_string(
+            package_data["extract"]["file_to_extract"], version
         )
+        if stream:
+            unpack = functools.partial(extract_stream, type_of_archive, file_to_extract)
+
+    started = time.perf_counter()
+    downloaded_file = None
+    #
+    # A revalidated package may have changed upstream without its URL changing, so the cache
+    # can't be trusted; only the server can say whether the installed copy is current.
+    #
+    if cache and not installed:
+        downloaded_file = cache.get(url, version)
+    if downloaded_file:
+        manifest.update(cache.validators(url, version), sha256=sha256sum(downloaded_file))
+        if sha256 and manifest["sha256"] != sha256.lower():
+            logger.warning("Cached download of %s failed checksum; discarding", binary_name)
+            cache.discard(url, version)
+            downloaded_file = None
+        else:
+            logger.debug("Using cached download %s", downloaded_file)
+
+    if not downloaded_file and offline:
+        logger.error("%s is not in the download cache; cannot install offline.", binary_name)
+        sys.exit(1)
+    elif not downloaded_file:
+        save_path = cache.staging(url, version) if cache and not unpack else download_dir
+        response = download(
+            url,
+            save_path,
+            installed,
+            unpack,
+            drain=bool(sha256),
+            retries=retries,
+            segments=segments,
+        )
+        if response.path is None:
+            timings["download"] = time.perf_counter() - started
+            logger.info("%s has not changed upstream", binary_name)
+            return FetchedPackage(binary_name, None, download_dir, installed, timings)
+        if sha256 and response.sha256 != sha256.lower():
+            logger.error("Checksum mismatch for %s downloaded from %s", binary_name, url)
+            sys.exit(1)
+        manifest.update(
+            etag=response.etag, last_modified=response.last_modified, sha256=response.sha256
+        )
+        if not unpack:
+            downloaded_file = cache.put(url, version, response) if cache else response.path
+    timings["stream" if unpack and not downloaded_file else "download"] = (
+        time.perf_counter() - started
+    )
+
+    if unpack and not downloaded_file:
+        binary_to_install = response.path
+    elif "extract" in package_data:
+        started = time.perf_counter()
+        binary_to_install = extract(type_of_archive, file_to_extract, downloaded_file, download_dir)
+        timings["extract"] = time.perf_counter() - started
+    elif cache:
+        #
+        # Installing moves the binary, so copy it out of the cache rather than lose the entry.
+        #
+        binary_to_install = shutil.copy(downloaded_file, download_dir)
     else:
         binary_to_install = downloaded_file
 
-    binary_full_path = PurePath.joinpath(install_path, binary_name)
-    move_bin(binary_to_install, binary_full_path)
-    chmod_exec(binary_full_path)
+    return FetchedPackage(binary_name, Path(binary_to_install), download_dir, manifest, timings)
+
+
+def install_fetched(install_path: Path, fetched: FetchedPackage) -> None:
+    """Installs a fetched binary and cleans up its temporary directory.
+
+    The binary is moved next to its final location under a hidden name and made executable
+    there, then renamed into place; a rename within a directory is atomic, so the install path
+    never holds a partially copied or non-executable binary.
+
+    Args:
+        install_path: The full path to the install directory.
+        fetched: The downloaded package returned by `fetch_binary()`.
+    """
+
+    if fetched.binary_path is None:
+        shutil.rmtree(fetched.download_dir, ignore_errors=True)
+        return
+
+    binary_full_path = PurePath.joinpath(install_path, fetched.binary_name)
+    staging_path = PurePath.joinpath(install_path, f".{fetched.binary_name}.infrastaller")
+
+    started = time.perf_counter()
+    move_bin(fetched.binary_path, staging_path)
+    fetched.timings["move"] = time.perf_counter() - started
 
-    logger.info("Installed %s to %s", binary_name, binary_full_path)
+    started = time.perf_counter()
+    chmod_exec(staging_path)
+    fetched.timings["chmod"] = time.perf_counter() - started
 
-    if Path.is_dir(download_dir):
-        logger.debug("Removing %s", download_dir)
-        shutil.rmtree(download_dir)
+    os.replace(staging_path, binary_full_path)
 
+    logger.info("Installed %s to %s", fetched.binary_name, binary_full_path)
 
-def download(source: str, save_path: Path) -> str:
-    """Download the package from a URL source."""
-    destination = PurePath.joinpath(save_path, os.path.basename(source))
+    if Path.is_dir(fetched.download_dir):
+        logger.debug("Removing %s", fetched.download_dir)
+        shutil.rmtree(fetched.download_dir)
+
+
+def log_summary(results: list, wall_time: float) -> None:
+    """Logs how long each package took and the total wall-clock time of the run.
+
+    Args:
+        results: The installed packages, as returned by `fetch_binary()`.
+        wall_time: Seconds elapsed for the whole run.
+    """
+
+    if not results:
+        return
+
+    for fetched in results:
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in fetched.timings.items())
+        logger.info("  %s: %.2fs (%s)", fetched.binary_name, sum(fetched.timings.values()), phases)
+
+    serial_time = sum(sum(fetched.timings.values()) for fetched in results)
+    unchanged = sum(1 for fetched in results if fetched.binary_path is None)
+    logger.info(
+        "Installed %d package(s), %d unchanged upstream, in %.2fs (%.2fs of package time)",
+        len(results) - unchanged,
+        unchanged,
+        wall_time,
+        serial_time,
+    )
+
+
+def download(
+    source: str,
+    save_path: Path,
+    validators: Optional[dict] = None,
+    unpack: Optional[Callable] = None,
+    drain: bool = False,
+    retries: int = DEFAULT_RETRIES,
+    segments: int = DEFAULT_SEGMENTS,
+) -> Download:
+    """Download the package from a URL source.
+
+    The response is copied to disk in `DOWNLOAD_CHUNK_SIZE` pieces through a single reusable
+    buffer, so memory use stays flat no matter how large the download is. Failed requests are
+    retried with exponential backoff, picking up where they left off (see
+    `download_resumable()`).
+
+    Args:
+        source: The URL to download.
+        save_path: The directory to save the download in.
+        validators: A previous response's `etag` and `last_modified` values; if given, the
+            request is conditional and nothing is downloaded if the resource is unchanged.
+        unpack: If given, called with the response stream and `save_path` instead of saving
+            the response; it returns the path of whatever it wrote (see `extract_stream()`).
+        drain: Read the rest of the response after `unpack` returns, so its digest is known.
+        retries: How many failed requests to retry before giving up.
+        segments: How many connections to download a large file over (ignored with `unpack`).
+    """
+    destination = Path(save_path) / os.path.basename(source)
     logger.debug("Downloading from %s", source)
-    logger.debug("Saving download to %s", destination)
-    with urllib.request.urlopen(source) as response, open(destination, "wb") as output:
-        output.write(response.read())
-    return destination
+
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    budget = RetryBudget(retries)
+    started = time.perf_counter()
+    while True:
+        try:
+            if unpack:
+                with open_url(source, headers) as response:
+                    reader = HashingReader(response)
+                    try:
+                        unpacked = unpack(reader, save_path)
+                    except (tarfile.TarError, EOFError, zlib.error):
+                        #
+                        # A connection dropped mid-body just looks like a truncated archive to
+                        # the decompressor, so retry it like any other incomplete read.
+                        #
+                        check_length(response, reader.size)
+                        raise
+                    result = Download(
+                        unpacked, response.headers["ETag"], response.headers["Last-Modified"]
+                    )
+                    if drain:
+                        reader.drain()
+                        check_length(response, reader.size)
+                    result.sha256, received = reader.hexdigest(), reader.size
+            else:
+                result, received = download_resumable(
+                    source, destination, headers, segments, budget
+                )
+            break
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                logger.debug("%s is not modified", source)
+                return Download(None, validators.get("etag"), validators.get("last_modified"))
+            budget.wait(source, error)
+        except RETRYABLE_ERRORS as error:
+            budget.wait(source, error)
+    elapsed = time.perf_counter() - started
+
+    logger.debug(
+        "Downloaded %s in %.2fs (%s/s)",
+        format_bytes(received),
+        elapsed,
+        format_bytes(received / max(elapsed, 1e-6)),
+    )
+    return result
+
+
+def open_url(source: str, headers: Optional[dict] = None):
+    """Sends a GET request for a URL and returns the response.
+
+    Requests go through the shared `connection_pool`, except when a proxy is configured for
+    the URL; those are left to urllib, which knows how to talk to proxies.
+    """
+    parts = urllib.parse.urlsplit(source)
+    if urllib.request.getproxies().get(parts.scheme) and not urllib.request.proxy_bypass(
+        parts.hostname
+    ):
+        request = urllib.request.Request(source, headers=headers or {})
+        return urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    return connection_pool.request(source, headers)
+
+
+def check_length(response, received: int) -> None:
+    """Raises IncompleteRead if fewer bytes were received than the response's Content-Length.
+
+    Unlike `read()`, `HTTPResponse.readinto()` treats a dropped connection as a normal end of
+    the body, so this has to be checked explicitly.
+    """
+    expected = int(response.headers["Content-Length"] or 0)
+    if received < expected:
+        raise http.client.IncompleteRead(b"", expected - received)
+
+
+def download_resumable(
+    source: str, destination: Path, headers: dict, segments: int, budget: RetryBudget
+) -> tuple:
+    """Downloads a URL to `<destination>.part`, then renames it to `destination` once complete.
+
+    An existing `.part` file is resumed with a Range request, guarded by an If-Range header so
+    that a resource which has changed since is downloaded afresh instead. The validator for
+    If-Range is kept in `<destination>.part.json`. Large files from servers that accept Range
+    requests may be split over several connections (see `download_segments()`).
+
+    Args:
+        source: The URL to download.
+        destination: The full path to save the download to.
+        headers: Extra request headers (e.g. for a conditional request).
+        segments: How many connections to download a large file over.
+        budget: The retry budget shared by every request for this download.
+
+    Returns:
+        The `Download` and the number of bytes received by this call.
+    """
+
+    partial = destination.with_name(f"{destination.name}.part")
+    partial_validators = partial.with_name(f"{partial.name}.json")
+
+    try:
+        with open(partial_validators, "rb") as saved:
+            validator = json.loads(saved.read())
+    except (OSError, ValueError):
+        validator = None
+    offset = partial.stat().st_size if partial.exists() else 0
+
+    request_headers = dict(headers)
+    if offset and validator:
+        request_headers["Range"] = f"bytes={offset}-"
+        request_headers["If-Range"] = validator
+
+    try:
+        response = open_url(source, request_headers)
+    except urllib.error.HTTPError as error:
+        if error.code != 416:
+            raise
+        #
+        # The partial file is no shorter than the resource, so it can't be resumed.
+        #
+        partial.unlink()
+        return download_resumable(source, destination, headers, segments, budget)
+
+    with response:
+        etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+        length = int(response.headers["Content-Length"] or 0)
+        segmented = False
+        if response.status == 206:
+            logger.debug("Resuming download of %s at %s", source, format_bytes(offset))
+        else:
+            offset = 0
+            partial_validators.unlink(missing_ok=True)
+            segmented = (
+                segments > 1
+                and length >= SEGMENT_MIN_SIZE
+                and response.headers["Accept-Ranges"] == "bytes"
+                and bool(etag or last_modified)
+            )
+            if not segmented and (etag or last_modified):
+                with open(partial_validators, "w", encoding="utf-8") as saved:
+                    json.dump(etag or last_modified, saved)
+
+        if not segmented:
+            logger.debug("Saving download to %s", partial)
+            reader = HashingReader(response)
+            with open(partial, "ab" if offset else "wb") as output:
+                copy_stream(reader, output)
+            received = reader.size
+            check_length(response, received)
+
+    if segmented:
+        download_segments(source, partial, length, segments, etag or last_modified, budget)
+        received = length
+
+    os.replace(partial, destination)
+    partial_validators.unlink(missing_ok=True)
+    #
+    # A digest computed while reading only covers this call's bytes, so anything resumed or
+    # segmented is hashed from disk instead.
+    #
+    digest = reader.hexdigest() if not offset and not segmented else sha256sum(destination)
+    return Download(destination, etag, last_modified, digest), received
 
 
-def extract(type_of_archive: str, file_to_extract: str, archive: Path) -> str:
-    """A wrapper method to extract tar.gz and zip archives.
+def download_segments(
+    source: str, partial: Path, size: int, segments: int, validator: str, budget: RetryBudget
+) -> None:
+    """Downloads a file over several connections at once, each fetching one byte range.
+
+    Each segment retries (from where it failed) on its own, drawing on the shared budget.
 
     Args:
-        type_of_archive: The file type of the archive (e.g. zip, targz).
+        source: The URL to download.
+        partial: The full path to save the download to.
+        size: The size of the file, in bytes.
+        segments: How many connections to download over.
+        validator: The ETag or Last-Modified header, used to make sure every segment comes from
+            the same version of the file.
+        budget: The retry budget shared by every request for this download.
+    """
+
+    logger.debug("Downloading %s over %d connections", source, segments)
+
+    with open(partial, "wb") as output:
+        output.truncate(size)
+
+    def fetch_segment(start: int, end: int) -> None:
+        with open(partial, "r+b") as output:
+            output.seek(start)
+            while output.tell() <= end:
+                headers = {"Range": f"bytes={output.tell()}-{end}", "If-Range": validator}
+                try:
+                    with open_url(source, headers) as response:
+                        if response.status != 206:
+                            raise RuntimeError(f"{source} changed while it was downloading")
+                        check_length(response, copy_stream(response, output))
+                except RETRYABLE_ERRORS as error:
+                    budget.wait(source, error)
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [
+            executor.submit(
+                fetch_segment, size * index // segments, size * (index + 1) // segments - 1
+            )
+            for index in range(segments)
+        ]
+        for future in futures:
+            future.result()
+
+
+def copy_stream(source, destination, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> int:
+    """Copies a readable binary stream to a writable one without buffering it whole.
+
+    Args:
+        source: A file-like object supporting `readinto()` (e.g. an HTTP response).
+        destination: A file-like object opened for binary writing.
+        chunk_size: The size of the reusable read buffer, in bytes.
+
+    Returns:
+        The number of bytes copied.
+    """
+
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    copied = 0
+    while True:
+        length = source.readinto(buffer)
+        if not length:
+            break
+        destination.write(view[:length])
+        copied += length
+    return copied
+
+
+def format_bytes(size: float) -> str:
+    """Formats a byte count as a human readable string (e.g. '12.3 MiB')."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+def sha256sum(filename: Union[Path, str]) -> str:
+    """Returns the hex SHA-256 digest of a file, read in `DOWNLOAD_CHUNK_SIZE` pieces."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        while chunk := file.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract(
+    type_of_archive: str, file_to_extract: str, archive: Path, destination: Optional[Path] = None
+) -> str:
+    """A wrapper method to extract a binary from a downloaded archive.
+
+    Args:
+        type_of_archive: The file type of the archive (see `extract_stream()`).
         file_to_extract: The filename to extract from the archive.
         archive: The full path to the compressed file.
+        destination: The directory to extract into (default: the archive's directory).
     """
 
     logger.debug("Extracting %s", archive)
 
-    destination = archive.parent
+    destination = destination or archive.parent
 
-    if type_of_archive == "targz":
-        with tarfile.open(archive, "r:gz") as tar_file:
-            tar_file.extract(file_to_extract, destination)
-    elif type_of_archive == "zip":
+    #
+    # A zip file on disk is seekable, so its central directory can be used to jump straight to
+    # the member; everything else is read front to back exactly as when streaming.
+    #
+    if type_of_archive == "zip":
         with zipfile.ZipFile(archive, "r") as zip_file:
             zip_file.extract(file_to_extract, destination)
+    else:
+        with open(archive, "rb") as archive_file:
+            extract_stream(type_of_archive, file_to_extract, archive_file, destination)
+
+    logger.debug("Extracted %s to %s", file_to_extract, destination)
+    return PurePath.joinpath(destination, file_to_extract)
+
+
+def extract_stream(type_of_archive: str, file_to_extract: str, stream, destination: Path) -> Path:
+    """Extracts a single file from an archive read front to back.
+
+    Reading stops as soon as the file has been written, so the rest of the archive is never
+    decompressed (or, when streaming a download, even received).
+
+    Args:
+        type_of_archive: The file type of the archive: 'targz', 'tarxz', 'tarzst', 'zip', or
+            'gz' for a bare gzipped binary.
+        file_to_extract: The filename to extract from the archive.
+        stream: A readable binary file-like object positioned at the start of the archive.
+        destination: The directory to extract into.
+    """
+
+    output_path = Path(destination) / file_to_extract
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if type_of_archive in TAR_STREAM_MODES:
+        if type_of_archive == "tarzst":
+            if zstandard is None:
+                logger.error("Archive type tarzst requires the 'zstandard' package.")
+                sys.exit(1)
+            stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        with tarfile.open(fileobj=stream, mode=TAR_STREAM_MODES[type_of_archive]) as tar_file:
+            for member in tar_file:
+                if member.name == file_to_extract and member.isfile():
+                    with tar_file.extractfile(member) as member_file:
+                        with open(output_path, "wb") as output:
+                            copy_stream(member_file, output)
+                    break
+            else:
+                logger.error("%s not found in archive.", file_to_extract)
+                sys.exit(1)
+    elif type_of_archive == "gz":
+        with gzip.GzipFile(fileobj=stream) as gz_file, open(output_path, "wb") as output:
+            copy_stream(gz_file, output)
+    elif type_of_archive == "zip":
+        with open(output_path, "wb") as output:
+            found = extract_zip_stream(stream, file_to_extract, output)
+        if not found:
+            logger.error("%s not found in archive.", file_to_extract)
+            sys.exit(1)
     else:
         logger.error("Archive type %s not supported.", type_of_archive)
         sys.exit(1)
 
     logger.debug("Extracted %s to %s", file_to_extract, destination)
-    return PurePath.joinpath(destination, file_to_extract)
+    return output_path
+
+
+def extract_zip_stream(stream, file_to_extract: str, output) -> bool:
+    """Extracts a single file from a zip archive read front to back.
+
+    A zip file's index (the central directory) is at its end, so instead this walks the local
+    header that precedes each member. Members before the wanted one are skipped; if a member's
+    size is only recorded after its data, it is decompressed and discarded to find its end.
+
+    Args:
+        stream: A readable binary file-like object positioned at the start of the archive.
+        file_to_extract: The filename to extract from the archive.
+        output: A file-like object opened for binary writing.
+
+    Returns:
+        Whether the file was found.
+    """
+
+    pending = bytearray()
+
+    def fill(size: int) -> bool:
+        while len(pending) < size:
+            chunk = stream.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                return False
+            pending.extend(chunk)
+        return True
+
+    def take(size: int) -> bytes:
+        if not fill(size):
+            raise EOFError("Truncated zip archive")
+        data = bytes(pending[:size])
+        del pending[:size]
+        return data
+
+    def copy(size: int, sink) -> int:
+        crc = 0
+        while size:
+            if not pending and not fill(1):
+                raise EOFError("Truncated zip archive")
+            piece = bytes(pending[:size])
+            del pending[: len(piece)]
+            if sink:
+                crc = zlib.crc32(piece, crc)
+                sink.write(piece)
+            size -= len(piece)
+        return crc
+
+    def inflate(sink) -> int:
+        crc = 0
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            if decompressor.unconsumed_tail:
+                data = decompressor.decompress(decompressor.unconsumed_tail, DOWNLOAD_CHUNK_SIZE)
+            elif pending or fill(1):
+                data = decompressor.decompress(bytes(pending), DOWNLOAD_CHUNK_SIZE)
+                pending.clear()
+            else:
+                raise EOFError("Truncated zip archive")
+            if sink:
+                crc = zlib.crc32(data, crc)
+                sink.write(data)
+        pending[:0] = decompressor.unused_data
+        return crc
+
+    while fill(4) and pending[:4] == b"PK\x03\x04":
+        _, _, flags, method, _, _, crc, compressed_size, _, name_length, extra_length = (
+            ZIP_LOCAL_HEADER.unpack(take(ZIP_LOCAL_HEADER.size))
+        )
+        name = take(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = take(extra_length)
+        has_descriptor = flags & 0x08
+
+        #
+        # Zip64: the real sizes are in the 0x0001 extra field, uncompressed size first, and any
+        # data descriptor has 8-byte sizes.
+        #
+        zip64 = compressed_size == 0xFFFFFFFF
+        offset = 0
+        while offset + 4 <= len(extra):
+            field_id, field_size = struct.unpack_from("<HH", extra, offset)
+            if field_id == 0x0001:
+                zip64 = True
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = struct.unpack_from("<Q", extra, offset + 12)[0]
+                break
+            offset += 4 + field_size
+
+        wanted = name == file_to_extract
+        sink = output if wanted else None
+        if wanted and method not in (0, 8):
+            logger.error("Cannot extract %s: unsupported zip compression method %d.", name, method)
+            sys.exit(1)
+        elif method == 8 and (wanted or has_descriptor):
+            written_crc = inflate(sink)
+        elif method == 0 and not (has_descriptor and compressed_size == 0):
+            written_crc = copy(compressed_size, sink)
+        elif not has_descriptor:
+            written_crc = copy(compressed_size, None)
+        else:
+            logger.error("Cannot stream %s: its size is unknown until after its data.", name)
+            sys.exit(1)
+
+        if has_descriptor:
+            fill(4)
+            signature = 4 if pending[:4] == b"PK\x07\x08" else 0
+            descriptor = take(signature + (20 if zip64 else 12))
+            crc = struct.unpack_from("<I", descriptor, signature)[0]
+
+        if wanted:
+            if written_crc != crc:
+                logger.error("CRC mismatch extracting %s from archive.", name)
+                sys.exit(1)
+            return True
+
+    return False
 
 
 def move_bin(source: Union[Path, str], destination: Union[Path, str]) -> None:
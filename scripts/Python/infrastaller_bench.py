@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""Benchmarks infrastaller against a local HTTP server.
+
+Generates synthetic tar.gz and zip packages, serves them from a throwaway HTTP server on the
+loopback interface, and installs them with `infrastaller.install_binary()` from a generated
+packages.json. The results (wall time, peak RSS, throughput and time per install phase) are
+printed to stdout as JSON, so that runs can be saved and compared across changes.
+
+Examples:
+
+    For example usage, see `python3 infrastaller_bench.py --help`.
+"""
+
+import functools
+import http.server
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+import logzero
+
+import infrastaller
+
+ARCHIVE_EXTENSIONS = {"targz": "tar.gz", "zip": "zip"}
+BENCH_VERSION = "1.0"
+CHUNK_SIZE = 1024 * 1024
+PHASES = ("download", "stream", "extract", "move", "chmod")
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files over HTTP/1.1 (so connections can be reused) without logging requests."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+def make_binary(path: Path, size: int) -> None:
+    """Writes a fake binary of `size` bytes.
+
+    Each chunk is half random and half repeated bytes, so that it compresses roughly as well
+    as a real executable would rather than not at all (or entirely).
+    """
+
+    with open(path, "wb") as binary:
+        remaining = size
+        while remaining:
+            length = min(CHUNK_SIZE, remaining)
+            binary.write(os.urandom(length // 2) + bytes(length - length // 2))
+            remaining -= length
+
+
+def make_packages(root: Path, types: tuple, count: int, size: int, base_url: str) -> dict:
+    """Creates `count` archives of each type in `root` and returns their packages.json config.
+
+    Args:
+        root: The directory to serve the archives from.
+        types: Which archive types to generate (`ARCHIVE_EXTENSIONS` keys).
+        count: How many archives to generate of each type.
+        size: The size in bytes of the binary inside each archive.
+        base_url: The URL that `root` is served at.
+    """
+
+    config = {}
+    scratch = root / ".scratch"
+    scratch.mkdir()
+    for type_of_archive in types:
+        config[type_of_archive] = {}
+        for number in range(count):
+            binary_name = f"bench-{type_of_archive}-{number}"
+            archive_name = f"{binary_name}-{BENCH_VERSION}.{ARCHIVE_EXTENSIONS[type_of_archive]}"
+            binary_path = scratch / binary_name
+            make_binary(binary_path, size)
+
+            if type_of_archive == "zip":
+                with zipfile.ZipFile(root / archive_name, "w", zipfile.ZIP_DEFLATED) as archive:
+                    archive.write(binary_path, binary_name)
+            else:
+                with tarfile.open(root / archive_name, "w:gz") as archive:
+                    archive.add(binary_path, binary_name)
+            binary_path.unlink()
+
+            config[type_of_archive][binary_name] = {
+                "version": BENCH_VERSION,
+                "url": f"{base_url}/{binary_name}-{{{{ version }}}}.{ARCHIVE_EXTENSIONS[type_of_archive]}",
+                "extract": {"type_of_archive": type_of_archive, "file_to_extract": binary_name},
+            }
+    scratch.rmdir()
+    return config
+
+
+def peak_rss() -> int:
+    """Returns the peak resident set size of this process so far, in bytes."""
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def run_once(catalog: infrastaller.Catalog, install_path: Path, jobs: int) -> dict:
+    """Installs every package in the catalog once and returns the run's measurements."""
+
+    infrastaller.connection_pool = infrastaller.ConnectionPool()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(
+            executor.map(
+                lambda item: infrastaller.install_binary(install_path, *item),
+                catalog.packages.items(),
+            )
+        )
+    wall_time = time.perf_counter() - started
+    infrastaller.connection_pool.close()
+
+    phases = {phase: 0.0 for phase in PHASES}
+    for fetched in results:
+        for phase, seconds in fetched.timings.items():
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    return {
+        "wall_time": wall_time,
+        "peak_rss": peak_rss(),
+        "phases": {phase: seconds for phase, seconds in phases.items() if seconds},
+        "connections": {
+            "opened": infrastaller.connection_pool.opened,
+            "reused": infrastaller.connection_pool.reused,
+        },
+    }
+
+
+@click.command()
+@click.option(
+    "-t",
+    "--type",
+    "types",
+    default=tuple(ARCHIVE_EXTENSIONS),
+    multiple=True,
+    show_default=True,
+    type=click.Choice(list(ARCHIVE_EXTENSIONS)),
+    help="Archive type to generate packages for.",
+)
+@click.option(
+    "-n",
+    "--count",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Packages to generate of each archive type.",
+)
+@click.option(
+    "-s",
+    "--size",
+    default=16,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Size of each packaged binary, in MiB.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=infrastaller.DEFAULT_JOBS,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Packages to install at a time.",
+)
+@click.option(
+    "-r",
+    "--repeat",
+    default=3,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Times to install every package.",
+)
+@click.option(
+    "-o",
+    "--output",
+    default="quiet",
+    show_default=True,
+    type=click.Choice(["quiet", "normal", "verbose", "debug"]),
+    help="Logging output level of infrastaller itself.",
+)
+def infrastaller_bench(
+    types: tuple, count: int, size: int, jobs: int, repeat: int, output: str
+) -> None:
+    """Benchmarks installing synthetic packages from a local HTTP server.
+
+    \b
+    Install four 16 MiB tar.gz and zip packages, three times over:
+        $ python3 infrastaller_bench.py
+
+    \b
+    Compare serial and parallel installs of many small tar.gz packages:
+        $ python3 infrastaller_bench.py --type targz --count 32 --size 1 > serial.json
+        $ python3 infrastaller_bench.py --type targz --count 32 --size 1 --jobs 8 > parallel.json
+    """
+
+    if output == "quiet":
+        logzero.loglevel(logzero.WARNING)
+    else:
+        infrastaller.configure_logging(output)
+
+    with tempfile.TemporaryDirectory(prefix="infrastaller-bench.") as workdir:
+        serve_path = Path(workdir, "serve")
+        serve_path.mkdir()
+        install_path = Path(workdir, "bin")
+        install_path.mkdir()
+
+        handler = functools.partial(QuietHandler, directory=str(serve_path))
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            base_url = f"http://127.0.0.1:{server.server_address[1]}"
+            config = make_packages(serve_path, types, count, size * 1024 * 1024, base_url)
+            config_path = Path(workdir, "packages.json")
+            config_path.write_text(json.dumps(config, indent=2))
+
+            catalog = infrastaller.load_config(config_path)
+            archive_bytes = sum(archive.stat().st_size for archive in serve_path.iterdir())
+            baseline_rss = peak_rss()
+
+            runs = []
+            for _ in range(repeat):
+                run = run_once(catalog, install_path, jobs)
+                run["bytes_per_sec"] = archive_bytes / run["wall_time"]
+                runs.append(run)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    wall_times = [run["wall_time"] for run in runs]
+    report = {
+        "python": platform.python_version(),
+        "platform": f"{infrastaller.SYSTEM}-{infrastaller.MACHINE}",
+        "packages": len(catalog.packages),
+        "types": list(types),
+        "binary_size": size * 1024 * 1024,
+        "archive_bytes": archive_bytes,
+        "jobs": jobs,
+        "baseline_rss": baseline_rss,
+        "runs": runs,
+        "summary": {
+            "wall_time_min": min(wall_times),
+            "wall_time_median": statistics.median(wall_times),
+            "bytes_per_sec_max": archive_bytes / min(wall_times),
+            "peak_rss": max(run["peak_rss"] for run in runs),
+        },
+    }
+    click.echo(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    # The following check is disabled because Click handles parameter values.
+    # pylint: disable=no-value-for-parameter
+    infrastaller_bench()
@@ -3,13 +3,17 @@
 __author__ = 'Bradley Frank'
 
 import argparse
+import hashlib
 import json
 import logging
 import os
-import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import HTTPError
 from urllib.error import URLError
 
@@ -18,38 +22,73 @@ PROJECTS = {
 }
 DOWNLOAD_DIR = '/usr/local/cache/yum2'
 GITHUB_URL = 'https://api.github.com/repos/'
+PROJECT_WORKERS = 4
 
-def get_latest_release(name, owner, repo, repolog):
+# Seconds between GitHub API requests, and the longest to wait for the
+# rate limit to reset before giving up on a project
+API_INTERVAL = 0.1
+API_MAX_WAIT = 60
+
+# Release feeds are cached (with only these fields of each asset) so that
+# they can be revalidated with conditional requests
+RELEASE_CACHE = os.path.join(DOWNLOAD_DIR, '.releases.json')
+ASSET_FIELDS = ['name', 'browser_download_url', 'size', 'digest']
+
+# RPMs are downloaded in chunks of this many bytes, and must start with
+# the RPM lead's magic number
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+RPM_MAGIC = b'\xed\xab\xee\xdb'
+
+# RPMs added or removed since the metadata was last generated, and where
+# createrepo keeps checksums between runs
+JOURNAL = os.path.join(DOWNLOAD_DIR, '.journal.json')
+CREATEREPO_CACHE_DIR = os.path.join(DOWNLOAD_DIR, '.createrepo-cache')
+
+def get_latest_release(name, owner, repo, repolog, limiter, cache, journal):
     # Create URL
     release_url = GITHUB_URL + owner + '/' + repo + '/releases/latest'
 
-    # Download release feed from GitHub
+    # Download release feed from GitHub, unless it hasn't changed
+    cached = cache.get(release_url)
+    headers = {}
+    if cached:
+        headers['If-None-Match'] = cached['etag']
+
     try:
-        response = urllib.request.urlopen(release_url)
+        response = limiter.urlopen(release_url, headers)
     except HTTPError as e:
-        print(name + ': could not download release information.')
-        repolog.log('error', e.code)
-        return False
+        if e.code != 304:
+            print(name + ': could not download release information.')
+            repolog.log('error', e.code)
+            return False
+        repolog.log('info', name + ': release information unchanged.')
+        assets = cached['assets']
     except URLError as e:
         print(name + ': could not download release information.')
         repolog.log('error', e.reason)
         return False
+    else:
+        data = response.read().decode('utf-8')
+        feed = json.loads(data)
 
-    data = response.readline().decode('utf-8')
-    feed = json.loads(data)
+        # Check that feed actually has releases
+        if 'assets' not in feed:
+            print(name + ': could not find release information.')
+            return False
+        else:
+            repolog.log('info', name + ': downloaded release information.')
 
-    # Check that feed actually has releases
-    if 'assets' not in feed:
-        print(name + ': could not find release information.')
-        return False
-    else:
-        repolog.log('info', name + ': downloaded release information.')
+        assets = feed['assets']
+        if response.headers.get('ETag'):
+            cache.put(release_url, response.headers['ETag'], assets)
 
     # Search releases for RPM file
-    for asset in feed['assets']:
+    for asset in assets:
         if asset['name'].endswith('.rpm'):
             download_url = asset['browser_download_url']
             rpm_name = asset['name']
+            rpm_size = asset.get('size')
+            rpm_digest = asset.get('digest')
             repolog.log('info', name + ': found latest release RPM.')
             break
     else:
@@ -59,8 +98,9 @@ def get_latest_release(name, owner, repo, repolog):
     # Append new version filename to repo directory
     filename = os.path.join(DOWNLOAD_DIR, rpm_name)
 
-    # Skip if file already exists
-    if os.path.isfile(filename):
+    # Skip if file already exists (and isn't a leftover partial file)
+    if os.path.isfile(filename) and \
+            rpm_size in (None, os.path.getsize(filename)):
         print(name + ': RPM is already at latest release.')
         return False
 
@@ -78,29 +118,294 @@ def get_latest_release(name, owner, repo, repolog):
 
     # Save the RPM file to disk
     try:
-        with open(filename, 'wb') as f:
-            shutil.copyfileobj(response, f)
-    except IOError as e:
+        received, elapsed = save_rpm(response, filename, rpm_size, rpm_digest)
+    except (IOError, ValueError) as e:
         print(name + ': could not save ' + rpm_name + '.')
         repolog.log('error', e)
         return False
+    journal.record(DOWNLOAD_DIR, added=[rpm_name])
+    repolog.log('info', '%s: downloaded %s at %s/s.' % (
+        name, format_bytes(received),
+        format_bytes(received / max(elapsed, 0.001))))
 
     print(name + ': updated to latest release.')
     return True
 
-def createrepo(repolog):
+def save_rpm(response, filename, size=None, digest=None):
+    # Stream a download to a temporary file next to its destination, check
+    # it's a complete RPM, and only then rename it into place
+    sha256 = hashlib.sha256()
+    received = 0
+    start = time.monotonic()
+    fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.part',
+                                    dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                f.write(chunk)
+                received += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if size is not None and received != size:
+            raise ValueError('expected %d bytes, received %d' % (size,
+                                                                 received))
+        if digest and digest.startswith('sha256:') and \
+                digest[len('sha256:'):] != sha256.hexdigest():
+            raise ValueError('SHA-256 digest does not match')
+        with open(tmp_path, 'rb') as f:
+            if f.read(len(RPM_MAGIC)) != RPM_MAGIC:
+                raise ValueError('not an RPM file')
+
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return received, time.monotonic() - start
+
+def format_bytes(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    return '%.1f %s' % (size, unit)
+
+def createrepo(repolog, journal):
+    # Only regenerate metadata that is missing or out of date
+    changes = journal.changes(DOWNLOAD_DIR)
+    repodata = os.path.isdir(os.path.join(DOWNLOAD_DIR, 'repodata'))
+    if repodata and not changes:
+        print('Repository is unchanged.')
+        return True
+
+    createrepo_command = ['createrepo', '--cachedir', CREATEREPO_CACHE_DIR]
+    if repodata:
+        # Reuse the existing metadata for everything but the changes
+        createrepo_command.append('--update')
+        repolog.log('info', '%d RPMs added, %d removed.' % (
+            len(changes['added']), len(changes['removed'])))
+    createrepo_command.append(DOWNLOAD_DIR)
+
     try:
-        subprocess.call(['createrepo', DOWNLOAD_DIR],
-                        stdout=open(os.devnull, 'wb'),
-                        stderr=open(os.devnull, 'wb'))
+        returncode = subprocess.call(createrepo_command,
+                                     stdout=open(os.devnull, 'wb'),
+                                     stderr=open(os.devnull, 'wb'))
     except OSError as e:
         print('Error creating repository.')
         repolog.log('error', e)
         return False
 
+    if returncode != 0:
+        print('Error creating repository.')
+        repolog.log('error', 'createrepo exited with status ' +
+                    str(returncode))
+        return False
+    journal.clear(DOWNLOAD_DIR)
+
     print('Successfully created repository.')
     return True
 
+class changeJournal:
+
+    def __init__(self, path, repolog):
+        # Records the RPMs added to and removed from each repository until
+        # its metadata has been regenerated, surviving failed runs
+        self.path = path
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.repos = json.load(f)
+        except (OSError, ValueError):
+            self.repos = {}
+
+    def record(self, repo_dir, added=(), removed=()):
+        if not added and not removed:
+            return True
+        with self.lock:
+            changes = self.repos.setdefault(repo_dir,
+                                            {'added': [], 'removed': []})
+            for rpm in added:
+                if rpm in changes['removed']:
+                    changes['removed'].remove(rpm)
+                if rpm not in changes['added']:
+                    changes['added'].append(rpm)
+            for rpm in removed:
+                if rpm in changes['added']:
+                    changes['added'].remove(rpm)
+                if rpm not in changes['removed']:
+                    changes['removed'].append(rpm)
+        return self.save()
+
+    def changes(self, repo_dir):
+        # Only report a repository whose RPMs actually changed
+        with self.lock:
+            changes = self.repos.get(repo_dir)
+            if changes and (changes['added'] or changes['removed']):
+                return changes
+            return None
+
+    def clear(self, repo_dir):
+        with self.lock:
+            self.repos.pop(repo_dir, None)
+        return self.save()
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.repos, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print('Could not save change journal.')
+                self.repolog.log('error', e)
+                return False
+        return True
+
+class releaseCache:
+
+    def __init__(self, path, repolog):
+        # Remembers each release feed's ETag and assets between runs, so
+        # that unchanged feeds are revalidated without spending API quota
+        self.path = path
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.feeds = json.load(f)
+        except (OSError, ValueError):
+            self.feeds = {}
+
+    def get(self, url):
+        with self.lock:
+            return self.feeds.get(url)
+
+    def put(self, url, etag, assets):
+        with self.lock:
+            self.feeds[url] = {
+                'etag': etag,
+                'assets': [{key: asset.get(key) for key in ASSET_FIELDS}
+                           for asset in assets],
+            }
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.feeds, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print('Could not save release cache.')
+                self.repolog.log('error', e)
+                return False
+        return True
+
+class rateLimiter:
+
+    def __init__(self, repolog, interval=API_INTERVAL,
+                 max_wait=API_MAX_WAIT):
+        # Spaces out GitHub API requests, and holds them back once the
+        # rate limit headers say the quota is spent until it resets
+        self.repolog = repolog
+        self.interval = interval
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.next_request = 0
+        self.remaining = None
+        self.reset = 0
+        self.probing = False
+        self.unlimited = False
+        self.announced = 0
+
+    def wait(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.remaining is None:
+                    if self.unlimited:
+                        break
+                    # Until a response says what the quota is, only let
+                    # one request through at a time
+                    if not self.probing:
+                        self.probing = True
+                        break
+                    self.condition.wait()
+                elif self.remaining > 0:
+                    # Count requests still in flight against the quota
+                    self.remaining -= 1
+                    break
+                elif self.reset > now:
+                    if self.reset - now > self.max_wait:
+                        return False
+                    if self.announced != self.reset:
+                        self.announced = self.reset
+                        self.repolog.log('warning',
+                                         'GitHub rate limit reached, '
+                                         'waiting %.0fs.' % (self.reset - now))
+                    self.condition.wait(self.reset - now)
+                else:
+                    self.remaining = None
+            slot = max(now, self.next_request)
+            self.next_request = slot + self.interval
+        time.sleep(slot - now)
+        return True
+
+    def update(self, headers, answered=True):
+        with self.condition:
+            remaining = headers.get('X-RateLimit-Remaining')
+            reset = headers.get('X-RateLimit-Reset')
+            retry_after = headers.get('Retry-After')
+            if remaining is not None and reset is not None:
+                # Responses can arrive out of order, so within the same
+                # window only ever lower the remaining quota
+                if int(reset) > self.reset or self.remaining is None:
+                    self.remaining = int(remaining)
+                    self.reset = int(reset)
+                elif int(reset) == self.reset:
+                    self.remaining = min(self.remaining, int(remaining))
+                self.unlimited = False
+            elif answered and self.remaining is None:
+                # Without rate limit headers there's no quota to keep to,
+                # so only space requests out from now on
+                self.unlimited = True
+            if retry_after is not None:
+                self.unlimited = False
+                self.remaining = 0
+                self.reset = max(self.reset, time.time() + int(retry_after))
+            self.probing = False
+            self.condition.notify_all()
+
+    def urlopen(self, url, headers=None):
+        # Open an API URL, retrying once if the request was rate limited
+        for retry in (True, False):
+            if not self.wait():
+                raise URLError('GitHub rate limit exceeded until ' +
+                               time.strftime('%H:%M:%S',
+                                             time.localtime(self.reset)))
+            try:
+                response = urllib.request.urlopen(
+                    urllib.request.Request(url, headers=headers or {}))
+            except HTTPError as e:
+                self.update(e.headers)
+                if retry and e.code in (403, 429) and self.remaining == 0:
+                    continue
+                raise
+            except URLError:
+                self.update({}, answered=False)
+                raise
+            self.update(response.headers)
+            return response
+
 class myLogger:
 
     def __init__(self, debug=False):
@@ -131,6 +436,8 @@ parser = argparse.ArgumentParser(
     description='Wrapper for reposync and createrepo.')
 parser.add_argument('-d', '--debug', action='store_true',
                     help='enables debug messages')
+parser.add_argument('-j', '--jobs', type=int, default=PROJECT_WORKERS,
+                    help='number of projects to update at once')
 args = parser.parse_args()
 
 # Configure debugging
@@ -143,9 +450,17 @@ else:
 if not os.path.isdir(DOWNLOAD_DIR):
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
-# Update each RPM
-for name, repo in PROJECTS.items():
-    get_latest_release(name, repo[0], repo[1], repolog)
+# Update each RPM, several projects at a time
+limiter = rateLimiter(repolog)
+cache = releaseCache(RELEASE_CACHE, repolog)
+journal = changeJournal(JOURNAL, repolog)
+with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+    updates = [executor.submit(get_latest_release, name, repo[0], repo[1],
+                               repolog, limiter, cache, journal)
+               for name, repo in PROJECTS.items()]
+for update in updates:
+    update.result()
+cache.save()
 
 # Re-create the repository
-createrepo(repolog)
+createrepo(repolog, journal)
@@ -1,16 +1,27 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import json
+import os
 import re
 import shutil
+import sqlite3
+import subprocess
+import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import PosixPath
 
 import logzero
 import requests
 
 # from mutagen import FileType, MutagenError
+from mutagen.easyid3 import EasyID3, EasyID3KeyError
 from mutagen.flac import FLAC, FLACNoHeaderError
+from mutagen.id3 import APIC, ID3
 from mutagen.mp3 import MP3, ID3FileType, HeaderNotFoundError
 from pydub import AudioSegment
 from pydub.exceptions import CouldntDecodeError, CouldntEncodeError
@@ -18,6 +29,76 @@ from pydub.exceptions import CouldntDecodeError, CouldntEncodeError
 
 DEFAULT_SOURCE_DIR = PosixPath.cwd()
 DEFAULT_OUTPUT_DIR = PosixPath.home() / "Music" / "mp3z"
+DEFAULT_JOBS = os.cpu_count() or 1
+BITRATE = "320k"
+DEFAULT_TRANSCODER = "pydub"
+# The external programs each streaming transcoder needs; pydub only needs ffmpeg to be
+# somewhere it can find it
+TRANSCODERS = {"pydub": [], "ffmpeg": ["ffmpeg"], "lame": ["flac", "lame"]}
+STATE_DB = ".mp3z.sqlite3"
+STATE_COMMIT_INTERVAL = 100
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files with these extensions are never audio, so they're skipped without being opened
+NON_AUDIO_EXTENSIONS = {
+    ".accurip",
+    ".bmp",
+    ".cue",
+    ".db",
+    ".ffp",
+    ".gif",
+    ".ini",
+    ".jpeg",
+    ".jpg",
+    ".log",
+    ".m3u",
+    ".m3u8",
+    ".md5",
+    ".nfo",
+    ".pdf",
+    ".png",
+    ".sfv",
+    ".tif",
+    ".tiff",
+    ".txt",
+    ".webp",
+}
+SNIFF_SIZE = 10
+QUEUE_DEPTH = 4
+MAGIC_NUMBERS = {
+    b"fLaC": "flac",
+    b"\xff\xd8\xff": "image",
+    b"\x89PNG\r\n\x1a\n": "image",
+    b"GIF87a": "image",
+    b"GIF89a": "image",
+}
+
+
+def sniff(file: PosixPath) -> str:
+    # Works out whether a file is FLAC, MP3 or an image from its extension or first few bytes,
+    # without handing it to mutagen; anything else is ""
+    if file.suffix.lower() in NON_AUDIO_EXTENSIONS:
+        return ""
+
+    with open(file, "rb") as f:
+        header = f.read(SNIFF_SIZE)
+        if header.startswith(b"ID3") and len(header) == SNIFF_SIZE:
+            # Look past the ID3v2 tag, which is usually on an MP3 but can be on a FLAC too
+            size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+            if header[5] & 0x10:
+                size += 10
+            f.seek(SNIFF_SIZE + size)
+            return "flac" if f.read(4) == b"fLaC" else "mp3"
+
+    for magic, file_type in MAGIC_NUMBERS.items():
+        if header.startswith(magic):
+            return file_type
+
+    # An MPEG audio frame sync, with a layer that isn't reserved
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0 and header[1] & 0x06:
+        return "mp3"
+
+    return ""
 
 
 def parse_args() -> argparse.ArgumentParser:
@@ -44,6 +125,25 @@ def parse_args() -> argparse.ArgumentParser:
         type=PosixPath,
         default=DEFAULT_OUTPUT_DIR,
     )
+    args_convert.add_argument(
+        "-j",
+        "--jobs",
+        help="number of songs to convert at once",
+        type=int,
+        default=DEFAULT_JOBS,
+    )
+    args_convert.add_argument(
+        "--verify",
+        help="compare file contents instead of trusting modification times",
+        action="store_true",
+    )
+    args_convert.add_argument(
+        "-t",
+        "--transcoder",
+        help="decode and encode in memory with pydub, or stream through ffmpeg or flac | lame",
+        choices=TRANSCODERS,
+        default=DEFAULT_TRANSCODER,
+    )
 
     args_tag = subparsers.add_parser("tag", help="tag MP3s via MusicBrainz")
     args_tag.add_argument("-s", "--source", help="source directory", type=PosixPath)
@@ -86,33 +186,51 @@ def set_logging(debug: bool, quiet: bool, verbose: bool) -> logzero.logging.Logg
 
 
 class Song:
-    def __init__(self, logger: logzero.logging.Logger, source: PosixPath, output_dir: PosixPath):
+    def __init__(
+        self,
+        logger: logzero.logging.Logger,
+        source: PosixPath,
+        output_dir: PosixPath,
+        transcoder: str = DEFAULT_TRANSCODER,
+        file_type: str = None,
+    ):
         self.lz = logger
         self.source = source
+        self.transcoder = transcoder
         self.output = output_dir / self.source.with_suffix(".mp3").name
         self.album, self.title, self.disc, self.track = ["", "", "", ""]
         self.track_number, self.total_tracks, self.disc_number, self.total_discs = [0, 0, 0, 0]
-
-        try:
-            FLAC(self.source)
-        except FLACNoHeaderError:
-            self.is_flac = False
-        else:
-            self.is_flac = True
+        self.length = 0.0
+
+        self.file_type = sniff(self.source) if file_type is None else file_type
+        self.is_flac = self.file_type == "flac"
+        self.is_mp3 = self.file_type == "mp3"
+
+        if self.is_flac:
+            try:
+                flac = FLAC(self.source)
+            except FLACNoHeaderError as exc:
+                self.lz.error(f"Error: could not read '{self.source.name}'")
+                raise IOError from exc
+            self.length = flac.info.length
             self.convert_to_mp3()
-
-        try:
-            MP3(self.source)
-        except HeaderNotFoundError:
-            self.is_mp3 = False
-        else:
-            self.is_mp3 = True
+            self.copy_tags(flac)
+        elif self.is_mp3:
+            try:
+                self.length = MP3(self.source).info.length
+            except HeaderNotFoundError as exc:
+                self.lz.error(f"Error: could not read '{self.source.name}'")
+                raise IOError from exc
             shutil.copy(self.source, self.output)
 
         self.is_audio = self.is_flac or self.is_mp3
 
     def convert_to_mp3(self) -> None:
-        self.lz.info(f"\U0000f001  '{self.source.name}' \U000027a1 '{self.output.name}'")
+        self.lz.debug(f"\U0000f001  '{self.source.name}' \U000027a1 '{self.output.name}'")
+
+        if self.transcoder != "pydub":
+            self.stream_to_mp3()
+            return
 
         try:
             flac = AudioSegment.from_file(self.source, format="flac")
@@ -121,7 +239,7 @@ class Song:
             raise IOError from exc
 
         try:
-            conversion_result = flac.export(self.output, format="mp3", bitrate="320k")
+            conversion_result = flac.export(self.output, format="mp3", bitrate=BITRATE)
         except (CouldntEncodeError, AttributeError) as exc:
             self.lz.error(f"Error: could not encode '{self.source.name}'")
             raise IOError from exc
@@ -130,6 +248,104 @@ class Song:
             self.lz.error(f"Error: could not convert '{self.source.name}'")
             raise IOError
 
+    def stream_to_mp3(self) -> None:
+        # Pipes the decoded audio straight into the encoder, so the track is never held in
+        # memory as PCM the way pydub's AudioSegment does
+        if self.transcoder == "ffmpeg":
+            # ffmpeg does both in one process, a buffer at a time
+            decoder = None
+            encoder = subprocess.Popen(
+                [
+                    "ffmpeg",
+                    "-nostdin",
+                    "-loglevel",
+                    "error",
+                    "-y",
+                    "-i",
+                    str(self.source),
+                    "-map",
+                    "0:a",
+                    "-map_metadata",
+                    "-1",
+                    "-codec:a",
+                    "libmp3lame",
+                    "-b:a",
+                    BITRATE,
+                    str(self.output),
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        else:
+            decoder = subprocess.Popen(
+                ["flac", "--decode", "--stdout", "--silent", str(self.source)],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            encoder = subprocess.Popen(
+                ["lame", "--quiet", "-b", BITRATE.rstrip("k"), "-", str(self.output)],
+                stdin=decoder.stdout,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            # Only the encoder should hold the pipe open, so it sees the decoder finish
+            decoder.stdout.close()
+
+        _, encoder_error = encoder.communicate()
+        failures = []
+        if decoder is not None:
+            decoder_error = decoder.stderr.read()
+            decoder.stderr.close()
+            if decoder.wait():
+                failures.append((decoder, decoder_error))
+        if encoder.returncode:
+            failures.append((encoder, encoder_error))
+
+        if failures:
+            process, error = failures[0]
+            self.output.unlink(missing_ok=True)
+            self.lz.error(f"Error: could not convert '{self.source.name}'")
+            message = error.decode(errors="replace").strip() or f"exit {process.returncode}"
+            raise IOError(f"{process.args[0]}: {message}")
+
+    def copy_tags(self, flac: FLAC) -> None:
+        # Carries the FLAC's Vorbis comments and pictures over to the MP3 as ID3 tags
+        tags = EasyID3()
+        vorbis = flac.tags.as_dict() if flac.tags else {}
+        for key, values in vorbis.items():
+            if key in ["tracktotal", "totaltracks", "disctotal", "totaldiscs"]:
+                continue
+            try:
+                tags[key] = values
+            except (EasyID3KeyError, ValueError):
+                self.lz.debug(f"  Skipping tag '{key}' on '{self.output.name}'")
+
+        # ID3 keeps the totals in the same frame, e.g. TRCK "3/12", as parse_id3_tags expects
+        for number, totals in [
+            ("tracknumber", ["tracktotal", "totaltracks"]),
+            ("discnumber", ["disctotal", "totaldiscs"]),
+        ]:
+            total = next((vorbis[key][0] for key in totals if key in vorbis), "")
+            if number in tags and total and "/" not in tags[number][0]:
+                tags[number] = f"{tags[number][0]}/{total}"
+        tags.save(self.output)
+
+        if flac.pictures:
+            id3 = ID3(self.output)
+            for picture in flac.pictures:
+                id3.add(
+                    APIC(
+                        encoding=3,
+                        mime=picture.mime,
+                        type=picture.type,
+                        desc=picture.desc,
+                        data=picture.data,
+                    )
+                )
+            id3.save()
+
     def sanitize(self, s):
         # TODO: Make this more robust, e.g. allow Japanese characters
         return "".join([c if c.isalnum() else "_" for c in s])
@@ -152,39 +368,273 @@ class Song:
         self.disc = self.disc_number.zfill(len(self.total_discs))
 
 
+@dataclass
+class Conversion:
+    source: PosixPath
+    output: PosixPath
+    is_flac: bool = False
+    is_audio: bool = False
+    length: float = 0.0
+    size: int = 0
+    mtime_ns: int = 0
+    digest: str = ""
+    unchanged: bool = False
+    error: str = ""
+
+
+def hash_file(file: PosixPath) -> str:
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def convert_song(
+    source: PosixPath,
+    output_dir: PosixPath,
+    known_digest: str = "",
+    transcoder: str = DEFAULT_TRANSCODER,
+    owner: str = "",
+) -> Conversion:
+    # Runs in a worker process, so report failures back rather than raising them: one bad
+    # file shouldn't stop the rest of the batch
+    try:
+        stat = source.stat()
+        file_type = sniff(source)
+        if file_type not in ("flac", "mp3"):
+            # Not audio, so there's nothing to convert and no need to read (or hash) the rest
+            return Conversion(source, output_dir, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        if owner:
+            output = output_dir / source.with_suffix(".mp3").name
+            return Conversion(source, output, error=f"'{output}' was converted from '{owner}'")
+
+        digest = hash_file(source)
+        if digest == known_digest:
+            return Conversion(
+                source, output_dir, size=stat.st_size, mtime_ns=stat.st_mtime_ns, unchanged=True
+            )
+        output_dir.mkdir(parents=True, exist_ok=True)
+        song = Song(logzero.logger, source, output_dir, transcoder, file_type)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        cause = exc.__cause__ or exc
+        return Conversion(source, output_dir, error=str(cause) or type(cause).__name__)
+    return Conversion(
+        source,
+        song.output,
+        song.is_flac,
+        song.is_audio,
+        song.length,
+        stat.st_size,
+        stat.st_mtime_ns,
+        digest,
+    )
+
+
+class State:
+    def __init__(self, logger: logzero.logging.Logger, output_dir: PosixPath):
+        # Remembers what has been converted already, so that re-runs only convert new or
+        # changed files
+        self.lz = logger
+        self.path = output_dir / STATE_DB
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS songs ("
+            " source TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " digest TEXT NOT NULL,"
+            " output TEXT,"
+            " bitrate TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS songs_output ON songs (output)")
+        self.uncommitted = 0
+
+    def check(
+        self, source: PosixPath, stat: os.stat_result, verify: bool, output: PosixPath
+    ) -> tuple:
+        # Returns whether the source is known to be converted already and, if it might not
+        # be, the digest its contents can be compared to before converting it again
+        row = self.db.execute(
+            "SELECT * FROM songs WHERE source = ?", (str(source.absolute()),)
+        ).fetchone()
+        if row is None or row["bitrate"] not in (None, BITRATE):
+            return False, ""
+        if row["output"] and (
+            row["output"] != str(output.absolute()) or not PosixPath(row["output"]).exists()
+        ):
+            return False, ""
+
+        if stat.st_size != row["size"]:
+            return False, ""
+        if verify or stat.st_mtime_ns != row["mtime_ns"]:
+            return False, row["digest"]
+        return True, row["digest"]
+
+    def owner(self, output: PosixPath) -> str:
+        # Returns the source an output was last converted from, if any
+        row = self.db.execute(
+            "SELECT source FROM songs WHERE output = ?", (str(output.absolute()),)
+        ).fetchone()
+        return row["source"] if row else ""
+
+    def record(self, song: Conversion) -> None:
+        if song.unchanged:
+            self.db.execute(
+                "UPDATE songs SET mtime_ns = ? WHERE source = ?",
+                (song.mtime_ns, str(song.source.absolute())),
+            )
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    str(song.source.absolute()),
+                    song.size,
+                    song.mtime_ns,
+                    song.digest,
+                    str(song.output.absolute()) if song.is_audio else None,
+                    BITRATE if song.is_flac else None,
+                ),
+            )
+
+        self.uncommitted += 1
+        if self.uncommitted >= STATE_COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self) -> None:
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
+
+
 class Album:
-    def __init__(self, logger, source_dir, output_dir):
+    def __init__(self, logger, source_dir, output_dir, transcoder=DEFAULT_TRANSCODER):
         self.lz = logger
         self.source_dir = source_dir
         self.output_dir = output_dir
-        self.files = self.walk(self.source_dir)
-        self.songs = []
-
-        uuid_regex = re.compile("[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}")
-
-        for file in self.files:
-            if uuid_regex.match(file.name):
-                self.mbid = file.name
-                continue
-            song = Song(self.lz, file, self.output_dir)
-            if song.is_audio:
-                self.songs.append(song)
+        self.transcoder = transcoder
+        self.mbid = ""
+        self.count, self.converted, self.copied, self.unchanged = [0, 0, 0, 0]
+        self.audio_seconds = 0.0
+        self.failed = []
+        self.uuid_regex = re.compile("[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}")
         # self.mp3s = [song.convert_to_mp3() if song.is_flac else song for song in self.songs]
         # self.songs = [song for song := Song(file) in self.files if song.is_filetype(file, FLAC)]
         # self.mp3s = [mp3 for song in self.songs if (mp3 := self.flac_to_mp3(song))]
 
-    def walk(self, directory: PosixPath) -> list:
-        self.lz.debug(f"\U0000f4d3  {directory.relative_to(self.source_dir)}")
-        files = []
-        for child in directory.iterdir():
-            if child.is_file():
-                files.append(child)
-                self.lz.debug(f"\U0000f0c6  {child.relative_to(directory)}")
-            elif child.is_dir():
-                files.extend(self.walk(child))
+    def convert(self, jobs: int, log_flags: tuple, state: State, verify: bool) -> list:
+        start = time.monotonic()
+
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=set_logging, initargs=log_flags
+        ) as executor:
+            # Files are converted as they're found, with only a few per worker queued up at a
+            # time, and reported back in the order they were found whichever finishes first
+            pending = deque()
+            try:
+                for entry in self.walk(self.source_dir):
+                    if self.uuid_regex.match(entry.name):
+                        self.mbid = entry.name
+                        continue
+                    # Sources that would be written to the same MP3 (e.g. "01.flac" and
+                    # "01.mp3" side by side) are never converted at the same time
+                    output = self.output_path(PosixPath(entry.path))
+                    while any(output == queued for _, queued, _ in pending):
+                        self.report(*pending.popleft(), state)
+                    pending.append(self.submit(executor, entry, output, state, verify))
+                    if len(pending) >= jobs * QUEUE_DEPTH:
+                        self.report(*pending.popleft(), state)
+                while pending:
+                    self.report(*pending.popleft(), state)
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        elapsed = max(time.monotonic() - start, 1e-6)
+        self.lz.info(
+            f"{self.converted} converted, {self.copied} copied, {self.unchanged} unchanged,"
+            f" {len(self.failed)} failed in {elapsed:.1f}s:"
+            f" {(self.converted + self.copied) / elapsed * 60:.1f} tracks/min,"
+            f" {self.audio_seconds / elapsed:.1f} audio-sec/sec"
+        )
+        return self.failed
+
+    def output_path(self, file: PosixPath) -> PosixPath:
+        # Mirrors the source tree, so tracks with the same name on different albums don't
+        # end up at the same path
+        return self.output_dir / file.relative_to(self.source_dir).with_suffix(".mp3")
+
+    def submit(
+        self, executor, entry: os.DirEntry, output: PosixPath, state: State, verify: bool
+    ) -> tuple:
+        file = PosixPath(entry.path)
+        if file.suffix.lower() in NON_AUDIO_EXTENSIONS:
+            return file, output, Conversion(file, output.parent)
+
+        try:
+            current, digest = state.check(file, entry.stat(), verify, output)
+        except OSError:
+            current, digest = False, ""
+        if current:
+            return file, output, Conversion(file, output, unchanged=True)
+
+        # Only refused once the worker knows it's audio, since that's all that's written
+        owner = state.owner(output)
+        if owner == str(file.absolute()):
+            owner = ""
+        future = executor.submit(convert_song, file, output.parent, digest, self.transcoder, owner)
+        return file, output, future
+
+    def report(self, file: PosixPath, output: PosixPath, item, state: State) -> None:
+        self.count += 1
+        progress = f"[{self.count}]"
+
+        if isinstance(item, Future):
+            try:
+                song = item.result()
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                song = Conversion(file, output, error=str(exc))
+            if not song.error:
+                state.record(song)
+        else:
+            song = item
+
+        if song.unchanged:
+            self.lz.debug(f"{progress} \U0000f0c6  {song.source.name} unchanged")
+            self.unchanged += 1
+        elif song.error:
+            self.lz.error(f"{progress} Error: '{song.source.name}': {song.error}")
+            self.failed.append(song)
+        elif song.is_audio:
+            self.lz.info(
+                f"{progress} \U0000f001  '{song.source.name}' \U000027a1 '{song.output.name}'"
+            )
+            if song.is_flac:
+                self.converted += 1
             else:
-                self.lz.debug(f"\U0000f0c6  {child.name} not a file or directory")
-        return files
+                self.copied += 1
+            self.audio_seconds += song.length
+        else:
+            self.lz.debug(f"{progress} \U0000f0c6  {song.source.name} not audio, skipped")
+
+    def walk(self, directory: str) -> Iterator[os.DirEntry]:
+        # Yields files as they're found rather than listing the whole tree first, using the
+        # file types scandir already knows to avoid extra stat calls
+        self.lz.debug(f"\U0000f4d3  {os.path.relpath(directory, self.source_dir)}")
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self.lz.debug(f"\U0000f0c6  {entry.name}")
+                    yield entry
+                elif entry.is_dir():
+                    yield from self.walk(entry.path)
+                else:
+                    self.lz.debug(f"\U0000f0c6  {entry.name} not a file or directory")
 
 
 #    def tag(self) -> None:
@@ -211,22 +661,40 @@ class Album:
 #            shutil.copy(m["file"], directory / filename)
 
 
-flags = parse_args()
-LZ = set_logging(flags.debug, flags.quiet, flags.verbose)
-flags.output.mkdir(parents=True, exist_ok=True)
-
-# if not flags.one:
-#    for folder in flags.source.iterdir():
-#        files = walk(flags.source, flags.source)
-#
-# if not files:
-#    LZ.warning(f"No files found")
-#    sys.exit(0)
-
-# match flags.subcommand:
-#    case "convert":
-#        convert(files, flags)
-#    case "rename":
-#        rename(files, flags)
-#    case "tag":
-#        tag(files, flags)
+def main() -> None:
+    flags = parse_args()
+    log_flags = (flags.debug, flags.quiet, flags.verbose)
+    lz = set_logging(*log_flags)
+
+    # if not flags.one:
+    #    for folder in flags.source.iterdir():
+    #        files = walk(flags.source, flags.source)
+    #
+    # if not files:
+    #    LZ.warning(f"No files found")
+    #    sys.exit(0)
+
+    match flags.subcommand:
+        case "convert":
+            flags.output.mkdir(parents=True, exist_ok=True)
+            transcoder = flags.transcoder
+            missing = [tool for tool in TRANSCODERS[transcoder] if not shutil.which(tool)]
+            if missing:
+                lz.warning(f"{', '.join(missing)} not found, falling back to pydub")
+                transcoder = "pydub"
+            album = Album(lz, flags.source, flags.output, transcoder)
+            state = State(lz, flags.output)
+            try:
+                failed = album.convert(max(flags.jobs, 1), log_flags, state, flags.verify)
+            finally:
+                state.close()
+            if failed:
+                raise SystemExit(1)
+        # case "rename":
+        #    rename(files, flags)
+        # case "tag":
+        #    tag(files, flags)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,72 +3,188 @@
 __author__ = 'Bradley Frank'
 
 import argparse
+import concurrent.futures
+import errno
+import fcntl
+import functools
+import hashlib
+import http.client
+import io
 import json
 import logging
 import os
-import shutil
+import random
+import re
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.error import URLError
 
 PROJECTS = {
     'Mailspring': ['Foundry376', 'Mailspring'],
     'VSCodium': ['VSCodium', 'vscodium'],
 }
+PROJECT_WORKERS = 4
 
-REPO_ROOT_DIR = '/srv/repos'
+# The environment can point reposyncer somewhere else entirely (e.g. at
+# local fixtures): the GitHub API, the repository root, the lock directory,
+# and a JSON file of projects to use instead of PROJECTS
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+if os.environ.get('REPOSYNCER_PROJECTS'):
+    with open(os.environ['REPOSYNCER_PROJECTS']) as f:
+        PROJECTS = json.load(f)
+
+# Seconds between GitHub API requests, and the longest to wait for the
+# rate limit to reset before giving up on a project
+API_INTERVAL = 0.1
+API_MAX_WAIT = 60
+
+# Seconds to wait on an unresponsive server, and redirects to follow
+HTTP_TIMEOUT = 60
+MAX_REDIRECTS = 10
+
+REPO_ROOT_DIR = os.environ.get('REPOSYNCER_ROOT', '/srv/repos')
 REPO_COLO = 'colo'
 REPOSITORIES = {
     'CentOS': '7',
     'Fedora': '29'
 }
+REPO_WORKERS = len(REPOSITORIES)
+
+# How many versions of each package to keep in the colo repository
+RETENTION_KEEP = 3
+
+# Release feeds are cached (with only these fields of each asset) so that
+# they can be revalidated with conditional requests
+RELEASE_CACHE = os.path.join(REPO_ROOT_DIR, '.releases.json')
+ASSET_FIELDS = ['name', 'browser_download_url', 'size', 'digest']
+
+# RPMs are downloaded in chunks of this many bytes, and must start with
+# the RPM lead's magic number
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+RPM_MAGIC = b'\xed\xab\xee\xdb'
+
+# RPMs added or removed since each repository's metadata was last
+# generated, and where createrepo keeps checksums between runs
+JOURNAL = os.path.join(REPO_ROOT_DIR, '.journal.json')
+CREATEREPO_CACHE_DIR = os.path.join(REPO_ROOT_DIR, '.createrepo-cache')
+
+# Hashes of the RPMs under REPO_ROOT_DIR, for hardlinking duplicates
+DEDUP_INDEX = os.path.join(REPO_ROOT_DIR, '.dedup.json')
+
+# Where each run's metrics are exported: a Prometheus textfile for
+# node_exporter (only if its collector directory exists), and a log of JSON
+# lines. Either can be turned off by passing an empty path.
+METRICS_TEXTFILE = '/var/lib/node_exporter/textfile_collector/reposyncer.prom'
+METRICS_LOG = '/var/log/reposyncer/metrics.jsonl'
+# How often the scheduler runs each job (in seconds, by default every
+# SYNC_INTERVAL), give or take a random JITTER of the interval; jobs first
+# run at random within STARTUP_SPREAD seconds of starting up. A job whose
+# repositories are locked by another run is retried after LOCK_RETRY seconds.
+SYNC_INTERVAL = 6 * 60 * 60
+INTERVALS = {
+    'Colo': 60 * 60,
+    'Dedup': 24 * 60 * 60,
+}
+JITTER = 0.1
+STARTUP_SPREAD = 60
+LOCK_RETRY = 60
+
+# Where each repository's lock file is kept
+LOCK_DIR = os.environ.get('REPOSYNCER_LOCK_DIR', '/run/lock/reposyncer')
+
+METRICS = [
+    ('duration_seconds', 'Seconds spent syncing the repository.'),
+    ('downloaded_bytes', 'Bytes downloaded into the repository.'),
+    ('files_added', 'RPMs added to the repository.'),
+    ('files_removed', 'RPMs removed from the repository.'),
+    ('createrepo_seconds', 'Seconds spent regenerating repository metadata.'),
+    ('http_requests', 'HTTP requests made to update the repository.'),
+    ('failures', 'Operations on the repository that failed.'),
+]
 
 PACKAGES = {}
 
 
 class rpm2repo:
 
-    def __init__(self, name, owner, repo, colo_dir, repolog):
-        self.releases_url = 'https://api.github.com/repos/' + \
+    def __init__(self, name, owner, repo, colo_dir, repolog, limiter,
+                 cache, journal):
+        self.releases_url = GITHUB_API_URL + '/repos/' + \
             owner + '/' + repo + '/releases/latest'
         self.colo_dir = colo_dir
         self.name = name
         self.repolog = repolog
+        self.limiter = limiter
+        self.cache = cache
+        self.journal = journal
+        self.requests = 0
+        self.bytes = 0
+        self.updated = False
+        self.failed = False
 
     def get_latest_release(self):
-        # Download release feed from GitHub
+        # Download release feed from GitHub, unless it hasn't changed
+        cached = self.cache.get(self.releases_url)
+        headers = {}
+        if cached:
+            headers['If-None-Match'] = cached['etag']
+
+        self.requests += 1
         try:
-            response = urllib.request.urlopen(self.releases_url)
+            response = self.limiter.urlopen(self.releases_url, headers)
         except HTTPError as e:
-            print(self.name + ': could not download release information.')
-            self.repolog.log('error', e.code)
-            return False
+            if e.code != 304:
+                print(self.name + ': could not download release information.')
+                self.repolog.log('error', e.code)
+                self.failed = True
+                return False
+            self.repolog.log('info',
+                             self.name + ': release information unchanged.')
+            assets = cached['assets']
         except URLError as e:
             print(self.name + ': could not download release information.')
             self.repolog.log('error', e.reason)
+            self.failed = True
             return False
+        else:
+            self.data = response.read().decode('utf-8')
+            self.feed = json.loads(self.data)
 
-        self.data = response.readall().decode('utf-8')
-        self.feed = json.loads(self.data)
+            # Check that feed actually has releases
+            if 'assets' not in self.feed:
+                print(self.name + ': could not find release information.')
+                self.failed = True
+                return False
+            else:
+                self.repolog.log('info', self.name +
+                                 ': downloaded release information.')
 
-        # Check that feed actually has releases
-        if 'assets' not in self.feed:
-            print(self.name + ': could not find release information.')
-            return False
-        else:
-            self.repolog.log('info',
-                             self.name + ': downloaded release information.')
+            assets = self.feed['assets']
+            if response.headers.get('ETag'):
+                self.cache.put(self.releases_url, response.headers['ETag'],
+                               assets)
 
         # Search releases for RPM file
-        for asset in self.feed['assets']:
+        for asset in assets:
             if asset['name'].endswith('.rpm'):
                 self.download_url = asset['browser_download_url']
                 self.rpm_name = asset['name']
+                self.rpm_size = asset.get('size')
+                self.rpm_digest = asset.get('digest')
                 self.repolog.log('info',
                                  self.name + ': found latest release RPM.')
                 break
         else:
             print('RPM file not found.')
+            self.failed = True
             return False
 
         # Append new version filename to repo directory
@@ -78,70 +194,492 @@ class rpm2repo:
         if not os.path.isdir(self.colo_dir):
             os.makedirs(self.colo_dir, exist_ok=True)
 
-        # Skip if file already exists
-        if os.path.isfile(self.filename):
+        # Skip if file already exists (and isn't a leftover partial file)
+        if os.path.isfile(self.filename) and \
+                self.rpm_size in (None, os.path.getsize(self.filename)):
             print(self.name + ': RPM is already at latest release.')
             return False
 
         # Download the actual RPM file
+        self.requests += 1
         try:
-            response = urllib.request.urlopen(self.download_url)
+            response = connections.urlopen(self.download_url)
         except HTTPError as e:
             print('Could not download release.')
             self.repolog.log('error', e.code)
+            self.failed = True
             return False
         except URLError as e:
             print('Could not download release.')
             self.repolog.log('error', e.reason)
+            self.failed = True
             return False
 
         # Save the RPM file to disk
         try:
-            with open(self.filename, 'wb') as f:
-                shutil.copyfileobj(response, f)
-        except IOError as e:
+            received, elapsed = save_rpm(response, self.filename,
+                                         self.rpm_size, self.rpm_digest)
+        except (IOError, ValueError) as e:
             print(self.name + ': could not save ' + self.rpm_name + '.')
             self.repolog.log('error', e)
+            self.failed = True
             return False
+        self.journal.record(self.colo_dir, added=[self.rpm_name])
+        self.bytes = received
+        self.updated = True
+        self.repolog.log('info', '%s: downloaded %s at %s/s.' % (
+            self.name, format_bytes(received),
+            format_bytes(received / max(elapsed, 0.001))))
 
         print(self.name + ': updated to latest release.')
         return True
 
 
+class pruner:
+
+    def __init__(self, name, repo_dir, keep, repolog, journal):
+        # Keeps only the newest few versions of each package in a repository
+        self.name = name
+        self.repo_dir = repo_dir
+        self.keep = keep
+        self.repolog = repolog
+        self.journal = journal
+        self.removed = []
+
+    def prune(self, dry_run=False, protect=()):
+        # Group RPMs by package name and architecture
+        packages = {}
+        for filename in os.listdir(self.repo_dir):
+            if not filename.endswith('.rpm'):
+                continue
+            nevra = split_nevra(filename)
+            if nevra is None:
+                self.repolog.log('debug', self.name + ': keeping ' + filename +
+                                 ', which is not named name-version-release.')
+                continue
+            packages.setdefault((nevra[0], nevra[4]), []).append(
+                (nevra, filename))
+
+        removed = []
+        reclaimed = 0
+        for rpms in packages.values():
+            rpms.sort(key=functools.cmp_to_key(
+                lambda a, b: compare_evr(a[0], b[0])), reverse=True)
+            for nevra, filename in rpms[self.keep:]:
+                if filename in protect:
+                    continue
+                path = os.path.join(self.repo_dir, filename)
+                try:
+                    stat = os.stat(path)
+                    if not dry_run:
+                        os.unlink(path)
+                except OSError as e:
+                    print(self.name + ': could not remove ' + filename + '.')
+                    self.repolog.log('error', e)
+                    continue
+                self.repolog.log('info', '%s: %s %s.' % (
+                    self.name, 'would remove' if dry_run else 'removed',
+                    filename))
+                removed.append(filename)
+                # Hardlinked copies elsewhere keep their space in use
+                if stat.st_nlink == 1:
+                    reclaimed += stat.st_size
+
+        if removed and not dry_run:
+            self.journal.record(self.repo_dir, removed=removed)
+            self.removed = removed
+        print('%s: %s %d old RPMs, reclaiming %s.' % (
+            self.name, 'would remove' if dry_run else 'removed',
+            len(removed), format_bytes(reclaimed)))
+        return True
+
+
+class deduplicator:
+
+    def __init__(self, index_path, repolog):
+        # Replaces byte-identical RPMs with hardlinks to a single copy. Each
+        # file's hash is remembered for as long as its inode, size and mtime
+        # are unchanged, so only new files need to be read.
+        self.index_path = index_path
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.reclaimed = 0
+        self.index = load_json(self.index_path)
+        self.hashed = set()
+        self.seen = set()
+        self.forget = False
+
+    def file_hash(self, path, stat):
+        key = '%d:%d' % (stat.st_dev, stat.st_ino)
+        self.seen.add(key)
+        entry = self.index.get(key)
+        if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        self.index[key] = [stat.st_size, stat.st_mtime_ns, sha256.hexdigest(),
+                           path]
+        self.hashed.add(key)
+        return sha256.hexdigest()
+
+    def copies(self):
+        # Find a known copy of each hash on each filesystem, from the index.
+        # This stats every indexed file, so build it once per run and pass it
+        # to each dedup() call rather than letting every call rebuild it.
+        copies = {}
+        for key, (size, mtime, digest, path) in list(self.index.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if key == '%d:%d' % (stat.st_dev, stat.st_ino) and \
+                    [size, mtime] == [stat.st_size, stat.st_mtime_ns]:
+                copies.setdefault((stat.st_dev, digest), path)
+        return copies
+
+    def dedup(self, paths, copies=None):
+        # Hardlink each RPM to the first copy found with the same content
+        with self.lock:
+            if copies is None:
+                copies = self.copies()
+
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                    digest = self.file_hash(path, stat)
+                    original = copies.setdefault((stat.st_dev, digest), path)
+                    if not os.path.lexists(original):
+                        # Removed since the copies were found, so this one
+                        # becomes the copy to link to
+                        original = copies[(stat.st_dev, digest)] = path
+                    if os.path.samefile(original, path):
+                        continue
+                except OSError as e:
+                    self.repolog.log('error', e)
+                    continue
+
+                # Link next to the duplicate, then rename over it
+                tmp_path = os.path.join(os.path.dirname(path),
+                                        '.' + os.path.basename(path) + '.link')
+                try:
+                    os.link(original, tmp_path)
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    print('Could not link ' + path + '.')
+                    self.repolog.log('error', e)
+                    if os.path.lexists(tmp_path):
+                        os.unlink(tmp_path)
+                    continue
+
+                self.repolog.log('debug', 'Linked ' + path + ' to ' + original)
+                self.linked += 1
+                if stat.st_nlink == 1:
+                    self.reclaimed += stat.st_size
+
+            return self.save()
+
+    def dedup_tree(self, root):
+        # Deduplicate every RPM under a directory, forgetting the hashes of
+        # files that are gone
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            paths.extend(os.path.join(dirpath, filename)
+                         for filename in filenames
+                         if filename.endswith('.rpm'))
+
+        with self.lock:
+            self.seen = set()
+            self.forget = True
+        return self.dedup(sorted(paths), copies={})
+
+    def save(self):
+        # Merge the hashes worked out since the last save into the index on
+        # disk, which other runs may have added to in the meantime. After a
+        # full walk, the index is replaced by the files that walk found.
+        def change(index):
+            if self.forget:
+                index.clear()
+                index.update((key, self.index[key]) for key in self.seen)
+            else:
+                index.update((key, self.index[key]) for key in self.hashed)
+
+        try:
+            self.index = update_json(self.index_path, change)
+            self.hashed = set()
+            self.seen = set()
+            self.forget = False
+        except OSError as e:
+            print('Could not save dedup index.')
+            self.repolog.log('error', e)
+            return False
+        return True
+
+
+class changeJournal:
+
+    def __init__(self, path, repolog):
+        # Records the RPMs added to and removed from each repository until
+        # its metadata has been regenerated, surviving failed runs
+        self.path = path
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        self.repos = load_json(self.path)
+
+    def record(self, repo_dir, added=(), removed=()):
+        if not added and not removed:
+            return True
+
+        def change(repos):
+            changes = repos.setdefault(repo_dir, {'added': [], 'removed': []})
+            for rpm in added:
+                if rpm in changes['removed']:
+                    changes['removed'].remove(rpm)
+                if rpm not in changes['added']:
+                    changes['added'].append(rpm)
+            for rpm in removed:
+                if rpm in changes['added']:
+                    changes['added'].remove(rpm)
+                if rpm not in changes['removed']:
+                    changes['removed'].append(rpm)
+        return self.save(change)
+
+    def changes(self, repo_dir):
+        # Only report a repository whose RPMs actually changed, rereading
+        # the journal in case another run has recorded changes since
+        with self.lock:
+            self.repos = load_json(self.path)
+            changes = self.repos.get(repo_dir)
+            if changes and (changes['added'] or changes['removed']):
+                return changes
+            return None
+
+    def clear(self, repo_dir):
+        return self.save(lambda repos: repos.pop(repo_dir, None))
+
+    def save(self, change):
+        # Apply the change to the journal on disk rather than writing out
+        # this process's copy of it, which may be stale
+        with self.lock:
+            try:
+                self.repos = update_json(self.path, change)
+            except OSError as e:
+                print('Could not save change journal.')
+                self.repolog.log('error', e)
+                return False
+        return True
+
+
+class releaseCache:
+
+    def __init__(self, path, repolog):
+        # Remembers each release feed's ETag and assets between runs, so
+        # that unchanged feeds are revalidated without spending API quota
+        self.path = path
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        self.feeds = load_json(self.path)
+        self.fetched = set()
+
+    def get(self, url):
+        with self.lock:
+            return self.feeds.get(url)
+
+    def put(self, url, etag, assets):
+        with self.lock:
+            self.feeds[url] = {
+                'etag': etag,
+                'assets': [{key: asset.get(key) for key in ASSET_FIELDS}
+                           for asset in assets],
+            }
+            self.fetched.add(url)
+
+    def save(self):
+        # Merge the feeds fetched since the last save into the cache on disk
+        with self.lock:
+            try:
+                self.feeds = update_json(self.path, lambda feeds: feeds.update(
+                    (url, self.feeds[url]) for url in self.fetched))
+                self.fetched = set()
+            except OSError as e:
+                print('Could not save release cache.')
+                self.repolog.log('error', e)
+                return False
+        return True
+
+
+class rateLimiter:
+
+    def __init__(self, repolog, interval=API_INTERVAL,
+                 max_wait=API_MAX_WAIT):
+        # Spaces out GitHub API requests, and holds them back once the
+        # rate limit headers say the quota is spent until it resets
+        self.repolog = repolog
+        self.interval = interval
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.next_request = 0
+        self.remaining = None
+        self.reset = 0
+        self.probing = False
+        self.unlimited = False
+        self.announced = 0
+
+    def wait(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.remaining is None:
+                    if self.unlimited:
+                        break
+                    # Until a response says what the quota is, only let
+                    # one request through at a time
+                    if not self.probing:
+                        self.probing = True
+                        break
+                    self.condition.wait()
+                elif self.remaining > 0:
+                    # Count requests still in flight against the quota
+                    self.remaining -= 1
+                    break
+                elif self.reset > now:
+                    if self.reset - now > self.max_wait:
+                        return False
+                    if self.announced != self.reset:
+                        self.announced = self.reset
+                        self.repolog.log('warning',
+                                         'GitHub rate limit reached, '
+                                         'waiting %.0fs.' % (self.reset - now))
+                    self.condition.wait(self.reset - now)
+                else:
+                    self.remaining = None
+            slot = max(now, self.next_request)
+            self.next_request = slot + self.interval
+        time.sleep(slot - now)
+        return True
+
+    def update(self, headers, answered=True):
+        with self.condition:
+            remaining = headers.get('X-RateLimit-Remaining')
+            reset = headers.get('X-RateLimit-Reset')
+            retry_after = headers.get('Retry-After')
+            if remaining is not None and reset is not None:
+                # Responses can arrive out of order, so within the same
+                # window only ever lower the remaining quota
+                if int(reset) > self.reset or self.remaining is None:
+                    self.remaining = int(remaining)
+                    self.reset = int(reset)
+                elif int(reset) == self.reset:
+                    self.remaining = min(self.remaining, int(remaining))
+                self.unlimited = False
+            elif answered and self.remaining is None:
+                # Without rate limit headers there's no quota to keep to,
+                # so only space requests out from now on
+                self.unlimited = True
+            if retry_after is not None:
+                self.unlimited = False
+                self.remaining = 0
+                self.reset = max(self.reset, time.time() + int(retry_after))
+            self.probing = False
+            self.condition.notify_all()
+
+    def urlopen(self, url, headers=None):
+        # Open an API URL, retrying once if the request was rate limited
+        for retry in (True, False):
+            if not self.wait():
+                raise URLError('GitHub rate limit exceeded until ' +
+                               time.strftime('%H:%M:%S',
+                                             time.localtime(self.reset)))
+            try:
+                response = connections.urlopen(url, headers)
+            except HTTPError as e:
+                self.update(e.headers)
+                if retry and e.code in (403, 429) and self.remaining == 0:
+                    continue
+                raise
+            except URLError:
+                self.update({}, answered=False)
+                raise
+            self.update(response.headers)
+            return response
+
+
 class reposyncer:
 
-    def __init__(self, os, version, repolog):
+    def __init__(self, os, version, repolog, journal):
         self.repo_name = os + ' ' + version
         self.os = os.lower()
         self.version = version
         self.repolog = repolog
+        self.journal = journal
+        self.bytes = 0
+        self.duration = 0
+        self.added = []
+        self.removed = []
 
     def reposync(self):
         # Build reposync command
         self.conf = os.path.join('/etc/reposyncer.d/',
                                  self.os + '_' + self.version)
-        self.repo = os.path.join('/srv/repos/', self.os, self.version)
+        self.repo = os.path.join(REPO_ROOT_DIR, self.os, self.version)
 
         reposync_command = [
             'reposync',
-            '-c',  + self.conf,
-            '-p',  + self.repo,
+            '-c', self.conf,
+            '-p', self.repo,
             '--gpgcheck',
             '--delete',
             '--downloadcomps',
             '--download-metadata',
-            '--quiet',
         ]
 
-        # Run the reposync process
+        before = snapshot(self.repo)
+        start = time.monotonic()
+
+        # Run the reposync process, passing its progress on to the log
         try:
-            subprocess.call(reposync_command,
-                            stdout=open(os.devnull, 'wb'),
-                            stderr=open(os.devnull, 'wb'))
+            with subprocess.Popen(reposync_command,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT,
+                                  universal_newlines=True,
+                                  errors='replace') as proc:
+                for line in proc.stdout:
+                    if line.strip():
+                        self.repolog.log('debug',
+                                         self.repo_name + ': ' + line.rstrip())
         except OSError as e:
             print(self.repo_name + ': error syncing repository.')
             self.repolog.log('error', e)
             return False
+        finally:
+            self.duration = time.monotonic() - start
+
+        # Count anything new or changed as transferred
+        after = snapshot(self.repo)
+        changed = [path for path, stat in after.items()
+                   if before.get(path) != stat]
+        self.bytes = sum(after[path][0] for path in changed)
+        self.added = [path for path in changed if path.endswith('.rpm')]
+        self.removed = [path for path in before
+                        if path not in after and path.endswith('.rpm')]
+
+        # Note which RPMs the metadata needs updating for
+        self.journal.record(
+            self.repo,
+            added=[os.path.relpath(path, self.repo) for path in self.added],
+            removed=[os.path.relpath(path, self.repo)
+                     for path in self.removed])
+
+        if proc.returncode != 0:
+            print(self.repo_name + ': error syncing repository.')
+            self.repolog.log('error', self.repo_name +
+                             ': reposync exited with status ' +
+                             str(proc.returncode))
+            return False
 
         print(self.repo_name + ': successfully synced repository.')
         return True
@@ -149,25 +687,332 @@ class reposyncer:
 
 class repocreator:
 
-    def __init__(self, name, repo_dir, repolog):
+    def __init__(self, name, repo_dir, repolog, journal):
         self.name = name
         self.colo_dir = repo_dir
         self.repolog = repolog
+        self.journal = journal
+        self.duration = 0
 
     def createrepo(self):
+        # Only regenerate metadata that is missing or out of date
+        changes = self.journal.changes(self.colo_dir)
+        repodata = os.path.isdir(os.path.join(self.colo_dir, 'repodata'))
+        if repodata and not changes:
+            print(self.name + ': repository is unchanged.')
+            return True
+
+        createrepo_command = ['createrepo', '--cachedir', CREATEREPO_CACHE_DIR]
+        if repodata:
+            # Reuse the existing metadata for everything but the changes
+            createrepo_command.append('--update')
+            self.repolog.log('info', '%s: %d RPMs added, %d removed.' % (
+                self.name, len(changes['added']), len(changes['removed'])))
+        createrepo_command.append(self.colo_dir)
+
+        start = time.monotonic()
         try:
-            subprocess.call(['createrepo', self.colo_dir],
-                            stdout=open(os.devnull, 'wb'),
-                            stderr=open(os.devnull, 'wb'))
+            returncode = subprocess.call(createrepo_command,
+                                         stdout=open(os.devnull, 'wb'),
+                                         stderr=open(os.devnull, 'wb'))
         except OSError as e:
             print(self.name + ': error creating repository.')
             self.repolog.log('error', e)
             return False
+        finally:
+            self.duration = time.monotonic() - start
+
+        if returncode != 0:
+            print(self.name + ': error creating repository.')
+            self.repolog.log('error', self.name +
+                             ': createrepo exited with status ' +
+                             str(returncode))
+            return False
+        self.journal.clear(self.colo_dir)
 
         print(self.name + ': successfully created repository.')
         return True
 
 
+class repoLock:
+
+    def __init__(self, name, repolog):
+        # Keeps two runs, from cron or the scheduler, from working on the
+        # same repository at the same time
+        self.name = name
+        self.path = os.path.join(LOCK_DIR,
+                                 name.lower().replace(' ', '_') + '.lock')
+        self.repolog = repolog
+        self.fd = None
+
+    def acquire(self):
+        # Returns True once locked, False if another run holds the lock, and
+        # raises OSError if the lock file can't be used at all
+        try:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            print(self.name + ': could not open lock ' + self.path + '.')
+            self.repolog.log('error', e)
+            raise
+
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            os.close(self.fd)
+            self.fd = None
+            if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return False
+            print(self.name + ': could not lock ' + self.path + '.')
+            self.repolog.log('error', e)
+            raise
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+class runMetrics:
+
+    def __init__(self, repolog):
+        # Collects per-repository measurements of a run, for export
+        self.repolog = repolog
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.started = {}
+
+    def start(self, repo):
+        # Forget a repository's measurements from any earlier run
+        with self.lock:
+            self.repos[repo] = {key: 0 for key, _ in METRICS}
+            self.started[repo] = time.time()
+
+    def add(self, repo, **values):
+        with self.lock:
+            if repo not in self.repos:
+                self.repos[repo] = {key: 0 for key, _ in METRICS}
+                self.started[repo] = time.time()
+            for key, value in values.items():
+                self.repos[repo][key] += value
+
+    def write_textfile(self, path):
+        # Write Prometheus text format for node_exporter's textfile
+        # collector, which must never see a half-written file
+        if not path:
+            return True
+        if not os.path.isdir(os.path.dirname(path) or '.'):
+            self.repolog.log('debug', 'No textfile collector directory for ' +
+                             path + ', not writing metrics.')
+            return True
+
+        metrics = METRICS + [
+            ('last_run_timestamp_seconds', 'When the last run started.')]
+        lines = []
+        with self.lock:
+            for key, description in metrics:
+                lines.append('# HELP reposyncer_%s %s' % (key, description))
+                lines.append('# TYPE reposyncer_%s gauge' % key)
+                for repo, values in sorted(self.repos.items()):
+                    label = repo.replace('\\', '\\\\').replace('"', '\\"')
+                    value = values.get(key, self.started[repo])
+                    lines.append('reposyncer_%s{repo="%s"} %s' % (
+                        key, label, value))
+
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print('Could not write metrics to ' + path + '.')
+            self.repolog.log('error', e)
+            return False
+        return True
+
+    def write_jsonl(self, path, repos=None):
+        # Append one JSON object per repository to a log of every run
+        if not path:
+            return True
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with self.lock, open(path, 'a') as f:
+                for repo, metrics in sorted(self.repos.items()):
+                    if repos is not None and repo not in repos:
+                        continue
+                    record = {'timestamp': self.started[repo], 'repo': repo}
+                    record.update(metrics)
+                    f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            print('Could not write metrics to ' + path + '.')
+            self.repolog.log('error', e)
+            return False
+        return True
+
+
+def save_rpm(response, filename, size=None, digest=None):
+    # Stream a download to a temporary file next to its destination, check
+    # it's a complete RPM, and only then rename it into place
+    sha256 = hashlib.sha256()
+    received = 0
+    start = time.monotonic()
+    fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.part',
+                                    dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                f.write(chunk)
+                received += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if size is not None and received != size:
+            raise ValueError('expected %d bytes, received %d' % (size,
+                                                                 received))
+        if digest and digest.startswith('sha256:') and \
+                digest[len('sha256:'):] != sha256.hexdigest():
+            raise ValueError('SHA-256 digest does not match')
+        with open(tmp_path, 'rb') as f:
+            if f.read(len(RPM_MAGIC)) != RPM_MAGIC:
+                raise ValueError('not an RPM file')
+
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return received, time.monotonic() - start
+
+
+def split_nevra(filename):
+    # Parse name-[epoch:]version-release.arch.rpm into its parts
+    nvra, _, arch = filename[:-len('.rpm')].rpartition('.')
+    parts = nvra.rsplit('-', 2)
+    if len(parts) != 3 or not all(parts) or not arch:
+        return None
+    name, version, release = parts
+    epoch = '0'
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+        if not epoch.isdigit():
+            return None
+    return name, epoch, version, release, arch
+
+
+def rpmvercmp(a, b):
+    # Compare two version (or release) strings the way rpm does: segment by
+    # segment, numbers numerically and letters alphabetically, with numbers
+    # newer than letters, '~' sorting before anything and '^' after
+    while a or b:
+        a = re.sub(r'^[^a-zA-Z0-9~^]+', '', a)
+        b = re.sub(r'^[^a-zA-Z0-9~^]+', '', b)
+
+        if a.startswith('~') or b.startswith('~'):
+            if not a.startswith('~'):
+                return 1
+            if not b.startswith('~'):
+                return -1
+            a, b = a[1:], b[1:]
+            continue
+        if a.startswith('^') or b.startswith('^'):
+            if not a:
+                return -1
+            if not b:
+                return 1
+            if not a.startswith('^'):
+                return 1
+            if not b.startswith('^'):
+                return -1
+            a, b = a[1:], b[1:]
+            continue
+        if not a or not b:
+            break
+
+        numeric = a[0] in '0123456789'
+        pattern = r'^[0-9]+' if numeric else r'^[a-zA-Z]+'
+        segment_a = re.match(pattern, a).group()
+        segment_b = re.match(pattern, b)
+        if segment_b is None:
+            return 1 if numeric else -1
+        segment_b = segment_b.group()
+        a, b = a[len(segment_a):], b[len(segment_b):]
+
+        if numeric:
+            segment_a = segment_a.lstrip('0')
+            segment_b = segment_b.lstrip('0')
+            if len(segment_a) != len(segment_b):
+                return 1 if len(segment_a) > len(segment_b) else -1
+        if segment_a != segment_b:
+            return 1 if segment_a > segment_b else -1
+
+    if not a and not b:
+        return 0
+    return 1 if a else -1
+
+
+def compare_evr(a, b):
+    # Compare the epoch, version and release of two split_nevra() results
+    if int(a[1]) != int(b[1]):
+        return 1 if int(a[1]) > int(b[1]) else -1
+    return rpmvercmp(a[2], b[2]) or rpmvercmp(a[3], b[3])
+
+
+def snapshot(directory):
+    # Map every file under a directory to its (size, mtime)
+    files = {}
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_json(path, change):
+    # Read, change and rewrite a JSON state file while holding an flock on
+    # it, so that runs in other processes (cron alongside the scheduler)
+    # don't overwrite each other's entries with a stale copy
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        data = load_json(path)
+        change(data)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    finally:
+        os.close(lock_fd)
+    return data
+
+
+def format_bytes(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    return '%.1f %s' % (size, unit)
+
+
 class myLogger:
 
     def __init__(self, debug=False):
@@ -194,31 +1039,303 @@ class myLogger:
         self.logger.log(level, msg)
 
 
+class connectionPool:
+
+    def __init__(self):
+        # Keeps HTTP(S) connections open between requests, so that a long
+        # running process isn't forever reconnecting to the same hosts
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def urlopen(self, url, headers=None):
+        # Send a GET request, following redirects, and raise HTTPError for
+        # anything unsuccessful, just as urllib.request.urlopen() would
+        if urllib.request.getproxies():
+            return urllib.request.urlopen(
+                urllib.request.Request(url, headers=headers or {}),
+                timeout=HTTP_TIMEOUT)
+
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self.request(url, headers or {})
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urllib.parse.urljoin(url, location)
+                headers = None
+                continue
+            if response.status >= 300:
+                body = response.read()
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, io.BytesIO(body))
+            return response
+        raise URLError('too many redirects')
+
+    def request(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        # Try an idle connection first; the server may have closed it
+        for reused in (True, False):
+            conn = None
+            if reused:
+                with self.lock:
+                    if self.idle.get(key):
+                        conn = self.idle[key].pop()
+                if conn is None:
+                    continue
+            elif parts.scheme == 'https':
+                conn = http.client.HTTPSConnection(parts.netloc,
+                                                   timeout=HTTP_TIMEOUT)
+            else:
+                conn = http.client.HTTPConnection(parts.netloc,
+                                                  timeout=HTTP_TIMEOUT)
+
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise URLError(e)
+            return pooledResponse(self, key, conn, response)
+
+    def checkin(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+
+class pooledResponse:
+
+    def __init__(self, pool, key, conn, response):
+        # A response that hands its connection back to the pool once it has
+        # been read to the end
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, size=-1):
+        try:
+            data = self.response.read(None if size < 0 else size)
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            raise IOError(e)
+        if self.response.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.checkin(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+connections = connectionPool()
+
+
 if __name__ == '__main__':
+    def _run_locked(names, job):
+        # Run a job while holding the lock of every repository it touches.
+        # Returns False if another run holds one of them, and None if one
+        # can't be locked at all.
+        locks = []
+        try:
+            for name in names:
+                lock = repoLock(name, repolog)
+                try:
+                    acquired = lock.acquire()
+                except OSError:
+                    lock_errors.append(name)
+                    return None
+                if not acquired:
+                    print(name + ': another run is in progress, skipping.')
+                    return False
+                locks.append(lock)
+            job()
+            return True
+        finally:
+            for lock in locks:
+                lock.release()
+
     def _rpm2repo():
         # Handle individual RPM updates
         colo_dir = os.path.join(REPO_ROOT_DIR, REPO_COLO)
+        start = time.monotonic()
+        metrics.start('Colo')
 
         for name, repo in PROJECTS.items():
-            PACKAGES[name] = rpm2repo(name, repo[0], repo[1], colo_dir, repolog)
-            PACKAGES[name].get_latest_release()
+            PACKAGES[name] = rpm2repo(name, repo[0], repo[1], colo_dir, repolog,
+                                      limiter, cache, journal)
+
+        # Poll and download releases several projects at a time
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            updated = list(executor.map(lambda rr: rr.get_latest_release(),
+                                        PACKAGES.values()))
+        cache.save()
+
+        if args.dedup_inline:
+            deduper.dedup([rr.filename for rr, ok
+                           in zip(PACKAGES.values(), updated) if ok])
+
+        # Prune old releases, never the latest ones
+        if args.keep:
+            latest = [rr.rpm_name for rr in PACKAGES.values()
+                      if hasattr(rr, 'rpm_name')]
+            pr = pruner('Colo', colo_dir, args.keep, repolog, journal)
+            pr.prune(args.dry_run, latest)
+            metrics.add('Colo', files_removed=len(pr.removed))
+
+        cr = repocreator('Colo', colo_dir, repolog, journal)
+        created = cr.createrepo()
+
+        rrs = PACKAGES.values()
+        metrics.add('Colo',
+                    duration_seconds=time.monotonic() - start,
+                    downloaded_bytes=sum(rr.bytes for rr in rrs),
+                    files_added=sum(rr.updated for rr in rrs),
+                    createrepo_seconds=cr.duration,
+                    http_requests=sum(rr.requests for rr in rrs),
+                    failures=sum(rr.failed for rr in rrs) + (not created))
+
+    def _reposyncer(repositories=REPOSITORIES):
+        # Sync repositories and regenerate their metadata, several at a time
+        copies = deduper.copies() if args.dedup_inline else None
+
+        def sync(rs):
+            metrics.start(rs.repo_name)
+            synced = rs.reposync()
+            if args.dedup_inline:
+                deduper.dedup(rs.added, copies)
+            print('%s: %s %s in %.1fs.' % (
+                rs.repo_name, 'synced' if synced else 'failed after',
+                format_bytes(rs.bytes), rs.duration))
+
+            cr = repocreator(rs.repo_name, rs.repo, repolog, journal)
+            created = cr.createrepo()
+            metrics.add(rs.repo_name,
+                        duration_seconds=rs.duration,
+                        downloaded_bytes=rs.bytes,
+                        files_added=len(rs.added),
+                        files_removed=len(rs.removed),
+                        createrepo_seconds=cr.duration,
+                        failures=(not synced) + (not created))
+
+        syncers = [reposyncer(os_name, version, repolog, journal)
+                   for os_name, version in repositories.items()]
 
-        cr = repocreator('Colo', colo_dir, repolog)
-        cr.createrepo()
+        # Returns False if any repository was skipped for being locked
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            return False not in list(executor.map(
+                lambda rs: _run_locked([rs.repo_name], lambda: sync(rs)),
+                syncers))
 
-    def _reposyncer():
-        # Sync all configured repositories
-        pass
+    def _deduplicator():
+        # Hardlink identical RPMs across all repositories
+        deduper.dedup_tree(REPO_ROOT_DIR)
+        print('Linked %d duplicate RPMs, reclaiming %s.' % (
+            deduper.linked, format_bytes(deduper.reclaimed)))
 
-    def _repocreator():
-        # Run createrepo across all repositories
-        pass
+    def _scheduler():
+        # Run each job on its own interval until stopped
+        jobs = {'Colo': functools.partial(_run_locked, ['Colo'], _rpm2repo)}
+        for os_name, version in REPOSITORIES.items():
+            jobs[os_name + ' ' + version] = functools.partial(
+                _reposyncer, {os_name: version})
+        if args.dedup:
+            jobs['Dedup'] = functools.partial(_run_locked, all_repos,
+                                              _deduplicator)
+
+        def run(name):
+            completed = jobs[name]()
+            metrics.write_textfile(args.metrics_textfile)
+            metrics.write_jsonl(args.metrics_log, [name])
+            return completed
+
+        now = time.time()
+        due = {name: now + random.uniform(0, STARTUP_SPREAD) for name in jobs}
+        started = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            while True:
+                now = time.time()
+                for name in jobs:
+                    if name not in running.values() and due[name] <= now:
+                        repolog.log('info', name + ': starting scheduled run.')
+                        started[name] = now
+                        running[executor.submit(run, name)] = name
+
+                idle = [due[name] for name in jobs
+                        if name not in running.values()]
+                timeout = max(0, min(idle) - now) if idle else None
+                done, _ = concurrent.futures.wait(
+                    running, timeout, concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        completed = future.result()
+                    except Exception as e:
+                        print(name + ': scheduled run failed.')
+                        repolog.log('error', e)
+                        completed = True
+
+                    if completed is False:
+                        # Another run holds the lock, so try again shortly
+                        # rather than waiting out a whole interval
+                        due[name] = time.time() + LOCK_RETRY
+                        repolog.log('info', '%s: busy, retrying at %s.' % (
+                            name, time.strftime('%H:%M:%S',
+                                                time.localtime(due[name]))))
+                        continue
+
+                    # Any runs that fell due while this one was going are
+                    # coalesced into a single run as soon as possible
+                    interval = INTERVALS.get(name, SYNC_INTERVAL)
+                    due[name] = max(started[name] + interval, time.time()) + \
+                        interval * random.uniform(-JITTER, JITTER)
+                    repolog.log('info', '%s: next run at %s.' % (
+                        name, time.strftime('%H:%M:%S',
+                                            time.localtime(due[name]))))
 
     # Set available arguments
     parser = argparse.ArgumentParser(
         description='Wrapper for reposync and createrepo.')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='enables debug messages')
+    parser.add_argument('-w', '--workers', type=int, default=REPO_WORKERS,
+                        help='number of repositories to sync at once')
+    parser.add_argument('-j', '--jobs', type=int, default=PROJECT_WORKERS,
+                        help='number of projects to update at once')
+    parser.add_argument('-k', '--keep', type=int, default=RETENTION_KEEP,
+                        help='number of versions of each package to keep '
+                             'in the colo repository (0 keeps all)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='report old RPMs instead of removing them')
+    parser.add_argument('--dedup', action='store_true',
+                        help='hardlink identical RPMs across repositories')
+    parser.add_argument('--dedup-inline', action='store_true',
+                        help='hardlink new RPMs to identical ones as they '
+                             'are downloaded')
+    parser.add_argument('--metrics-textfile', default=METRICS_TEXTFILE,
+                        help='Prometheus textfile to write run metrics to')
+    parser.add_argument('--metrics-log', default=METRICS_LOG,
+                        help='file to append run metrics to as JSON lines')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, syncing each repository on its '
+                             'own schedule')
     args = parser.parse_args()
 
     # Configure debugging
@@ -227,7 +1344,34 @@ if __name__ == '__main__':
     else:
         repolog = myLogger(False)
 
+    # Loaded once, and kept warm between scheduled runs
+    journal = changeJournal(JOURNAL, repolog)
+    deduper = deduplicator(DEDUP_INDEX, repolog)
+    metrics = runMetrics(repolog)
+    limiter = rateLimiter(repolog)
+    cache = releaseCache(RELEASE_CACHE, repolog)
+    all_repos = ['Colo'] + [os_name + ' ' + version
+                            for os_name, version in REPOSITORIES.items()]
+    lock_errors = []
+
     # Execute desired processes
-    _rpm2repo()
-    _reposyncer()
-    _repocreator()
+    if args.daemon:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            _scheduler()
+        except KeyboardInterrupt:
+            pass
+    else:
+        _run_locked(['Colo'], _rpm2repo)
+        _reposyncer()
+        if args.dedup:
+            _run_locked(all_repos, _deduplicator)
+        elif args.dedup_inline:
+            print('Linked %d duplicate RPMs, reclaiming %s.' % (
+                deduper.linked, format_bytes(deduper.reclaimed)))
+
+        # Export metrics for the run
+        metrics.write_textfile(args.metrics_textfile)
+        metrics.write_jsonl(args.metrics_log)
+        if lock_errors:
+            sys.exit(1)
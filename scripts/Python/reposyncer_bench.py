@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+__author__ = 'Bradley Frank'
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+REPOSYNCER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'reposyncer.py')
+RPM_MAGIC = b'\xed\xab\xee\xdb'
+
+# Stub executables, which note when they start and finish in a log so that
+# their concurrency can be measured afterwards
+REPOSYNC_STUB = '''#!/bin/sh
+echo "start $(date +%%s.%%N)" >> '%(log)s'
+while [ $# -gt 0 ]; do
+    case "$1" in -p) repo=$2; shift;; esac
+    shift
+done
+mkdir -p "$repo"
+sleep %(latency)s
+for i in $(seq 1 %(rpms)d); do
+    echo "package-$i-1.0-1.noarch.rpm"
+    [ -f "$repo/package-$i-1.0-1.noarch.rpm" ] ||
+        printf '\\355\\253\\356\\333' > "$repo/package-$i-1.0-1.noarch.rpm"
+done
+echo "end $(date +%%s.%%N)" >> '%(log)s'
+'''
+CREATEREPO_STUB = '''#!/bin/sh
+echo "start $(date +%%s.%%N)" >> '%(log)s'
+for repo; do :; done
+sleep %(latency)s
+mkdir -p "$repo/repodata"
+echo "end $(date +%%s.%%N)" >> '%(log)s'
+'''
+
+
+class fakeGitHub(ThreadingHTTPServer):
+
+    def __init__(self, rpm_size, latency, quota):
+        # Serves /repos/<owner>/<repo>/releases/latest like the GitHub API
+        # (with ETags and rate limit headers), and the RPMs it points to
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), fakeHandler)
+        self.latency = latency
+        self.quota = quota
+        self.rpm = RPM_MAGIC + os.urandom(rpm_size - len(RPM_MAGIC))
+        self.digest = 'sha256:' + hashlib.sha256(self.rpm).hexdigest()
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.counters = {'api_requests': 0, 'not_modified': 0,
+                             'rate_limited': 0, 'downloads': 0,
+                             'bytes_sent': 0}
+            self.in_flight = {'api': 0, 'download': 0}
+            self.peak = {'api': 0, 'download': 0}
+            self.remaining = self.quota
+            self.reset = int(time.time()) + 3600
+
+    def count(self, kind, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+            self.in_flight[kind] += 1
+            self.peak[kind] = max(self.peak[kind], self.in_flight[kind])
+
+    def done(self, kind):
+        with self.lock:
+            self.in_flight[kind] -= 1
+
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class fakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        match = re.match(r'^/repos/([^/]+)/([^/]+)/releases/latest$',
+                         self.path)
+        if match:
+            server.count('api', 'api_requests')
+            try:
+                time.sleep(server.latency)
+                self.release(match.group(2))
+            finally:
+                server.done('api')
+        elif self.path.startswith('/assets/'):
+            server.count('download', 'downloads')
+            try:
+                time.sleep(server.latency)
+                self.reply(200, server.rpm)
+                with server.lock:
+                    server.counters['bytes_sent'] += len(server.rpm)
+            finally:
+                server.done('download')
+        else:
+            self.reply(404, b'')
+
+    def release(self, repo):
+        server = self.server
+        etag = '"%s"' % hashlib.sha256(repo.encode()).hexdigest()[:16]
+        headers = {'ETag': etag}
+
+        with server.lock:
+            # Conditional requests that match don't cost any quota
+            if self.headers.get('If-None-Match') == etag:
+                server.counters['not_modified'] += 1
+                status = 304
+            elif server.quota and server.remaining <= 0:
+                server.counters['rate_limited'] += 1
+                status = 403
+            else:
+                server.remaining -= 1
+                status = 200
+            if server.quota:
+                headers['X-RateLimit-Remaining'] = str(max(server.remaining,
+                                                           0))
+                headers['X-RateLimit-Reset'] = str(server.reset)
+
+        body = b''
+        if status == 200:
+            name = repo + '-1.0-1.x86_64.rpm'
+            body = json.dumps({'assets': [{
+                'name': name,
+                'size': len(server.rpm),
+                'digest': server.digest,
+                'browser_download_url': server.url() + '/assets/' + name,
+            }]}).encode('utf-8')
+        self.reply(status, body, headers)
+
+    def reply(self, status, body, headers=None):
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def write_stub(path, template, **values):
+    with open(path, 'w') as f:
+        f.write(template % values)
+    os.chmod(path, 0o755)
+
+
+def stub_stats(log):
+    # Count a stub's runs, and the most that were ever running at once
+    events = []
+    try:
+        with open(log) as f:
+            for line in f:
+                kind, timestamp = line.split()
+                events.append((float(timestamp), kind == 'start'))
+    except OSError:
+        pass
+
+    running = peak = 0
+    for timestamp, starting in sorted(events):
+        running += 1 if starting else -1
+        peak = max(peak, running)
+    return {'runs': sum(starting for _, starting in events),
+            'peak_concurrency': peak}
+
+
+def run_once(workdir, server, env, args):
+    # Run reposyncer end to end and gather what the fixtures saw
+    for log in ('reposync.log', 'createrepo.log'):
+        if os.path.exists(os.path.join(workdir, log)):
+            os.unlink(os.path.join(workdir, log))
+    server.reset_counters()
+    metrics_log = os.path.join(workdir, 'metrics.jsonl')
+    if os.path.exists(metrics_log):
+        os.unlink(metrics_log)
+
+    command = [
+        sys.executable, REPOSYNCER,
+        '--jobs', str(args.jobs),
+        '--workers', str(args.workers),
+        '--metrics-textfile', os.path.join(workdir, 'reposyncer.prom'),
+        '--metrics-log', metrics_log,
+    ]
+    start = time.monotonic()
+    proc = subprocess.run(command, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    wall_time = time.monotonic() - start
+    if args.verbose:
+        sys.stderr.write(proc.stdout)
+
+    repos = {}
+    try:
+        with open(metrics_log) as f:
+            for line in f:
+                record = json.loads(line)
+                repos[record.pop('repo')] = record
+    except OSError:
+        pass
+
+    return {
+        'exit_status': proc.returncode,
+        'wall_time': wall_time,
+        'requests': dict(server.counters),
+        'peak_concurrency': {
+            'api_requests': server.peak['api'],
+            'downloads': server.peak['download'],
+        },
+        'reposync': stub_stats(os.path.join(workdir, 'reposync.log')),
+        'createrepo': stub_stats(os.path.join(workdir, 'createrepo.log')),
+        'repos': repos,
+    }
+
+
+if __name__ == '__main__':
+    # Set available arguments
+    parser = argparse.ArgumentParser(
+        description='Benchmark reposyncer against local fixtures.')
+    parser.add_argument('-p', '--projects', type=int, default=50,
+                        help='number of synthetic GitHub projects')
+    parser.add_argument('-s', '--size', type=int, default=1024,
+                        help='size of each release RPM, in KiB')
+    parser.add_argument('-r', '--runs', type=int, default=2,
+                        help='number of runs against the same repositories '
+                             '(later runs find everything up to date)')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of projects reposyncer updates at once')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='number of repositories reposyncer syncs at once')
+    parser.add_argument('--http-latency', type=float, default=0.05,
+                        help='seconds the fake GitHub takes to respond')
+    parser.add_argument('--reposync-latency', type=float, default=1.0,
+                        help='seconds the stub reposync takes to run')
+    parser.add_argument('--createrepo-latency', type=float, default=0.5,
+                        help='seconds the stub createrepo takes to run')
+    parser.add_argument('--rpms', type=int, default=20,
+                        help='number of RPMs the stub reposync writes')
+    parser.add_argument('--quota', type=int, default=0,
+                        help='API rate limit quota to enforce (0 for none)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="pass on reposyncer's output")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='reposyncer-bench.') as workdir:
+        bin_dir = os.path.join(workdir, 'bin')
+        os.makedirs(bin_dir)
+        write_stub(os.path.join(bin_dir, 'reposync'), REPOSYNC_STUB,
+                   log=os.path.join(workdir, 'reposync.log'),
+                   latency=args.reposync_latency, rpms=args.rpms)
+        write_stub(os.path.join(bin_dir, 'createrepo'), CREATEREPO_STUB,
+                   log=os.path.join(workdir, 'createrepo.log'),
+                   latency=args.createrepo_latency)
+
+        projects = {'project%d' % i: ['owner', 'project%d' % i]
+                    for i in range(args.projects)}
+        projects_file = os.path.join(workdir, 'projects.json')
+        with open(projects_file, 'w') as f:
+            json.dump(projects, f)
+
+        server = fakeGitHub(args.size * 1024, args.http_latency, args.quota)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        env = dict(os.environ,
+                   PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                   GITHUB_API_URL=server.url(),
+                   REPOSYNCER_ROOT=os.path.join(workdir, 'repos'),
+                   REPOSYNCER_LOCK_DIR=os.path.join(workdir, 'locks'),
+                   REPOSYNCER_PROJECTS=projects_file)
+        for proxy in ('http_proxy', 'https_proxy', 'HTTP_PROXY',
+                      'HTTPS_PROXY'):
+            env.pop(proxy, None)
+
+        try:
+            runs = [run_once(workdir, server, env, args)
+                    for _ in range(args.runs)]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    print(json.dumps({
+        'projects': args.projects,
+        'rpm_size': args.size * 1024,
+        'jobs': args.jobs,
+        'workers': args.workers,
+        'runs': runs,
+    }, indent=2))